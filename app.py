@@ -1,16 +1,18 @@
-from flask import Flask, request, jsonify, make_response, Response
+from flask import Flask, request, jsonify, make_response, Response, send_file, stream_with_context
 from flask import render_template
 from flask_restx import Api, Resource, fields
 
 from datetime import datetime, timedelta
 
 import numpy as np
+import calendar
 import json
 import os
 
 from simulation import Simulation
 from weather_conditions import WeatherConditions
 from mission import Mission
+import transport
 
 flask_app = Flask(__name__)
 
@@ -77,6 +79,17 @@ simulation = None
 weatherConditions = None
 mission = None
 
+# Conditional GET: artifacts are tagged with the version they were built from, unchanged ones are answered with 304
+def not_modified(etag):
+	if not request.if_none_match.contains(etag):
+		return None
+	return tagged(make_response('', 304), etag)
+
+def tagged(response, etag):
+	response.set_etag(etag)
+	response.headers.add('Access-Control-Expose-Headers', 'ETag, X-Snapshot-Version')
+	return response
+
 # HTML rendering
 @flask_app.route('/index', methods=['GET'])
 def display_index():
@@ -157,6 +170,25 @@ def display_stoped():
 
 	return display_viz()
 
+# Server-sent events: 'step' (new particles), 'kde' (robot consumption), 'mission' (new mission) and 'robots' (robot moves),
+# clients refetch the changed artifacts instead of polling
+@flask_app.route('/events', methods=['GET'])
+def events():
+	if (simulation == None):
+		response = jsonify({
+				"statusCode": 404,
+				"status": "Simulation not started"
+			})
+	else:
+		last_id = request.headers.get('Last-Event-ID', '')
+		stream = simulation.events.stream(int(last_id) if last_id.isdigit() else None)
+		response = Response(stream_with_context(stream), mimetype='text/event-stream')
+		response.headers['Cache-Control'] = 'no-cache'
+		response.headers['X-Accel-Buffering'] = 'no'
+
+	response.headers.add('Access-Control-Allow-Origin', '*')
+	return response
+
 # API requests
 @ns_config.route("/simulation")
 class MainClass(Resource):
@@ -266,52 +298,213 @@ class MainClass(Resource):
 			})
 
 
+def grid_response(data, format_name, compress, etag):
+	response = tagged(make_response(data), etag)
+	response.headers['Content-Type'] = transport.GRID_FORMATS[format_name]
+	if compress:
+		response.headers['Content-Encoding'] = 'gzip'
+	return response
+
 @ns_mission.route("/kde")
+@ns_mission.param('format', 'json (default), f32, u16 or u8 (binary grid, see transport.encode_grid). Also negotiated with the Accept header')
 class MainClass(Resource):
 	def get(self):
-		kde = mission.get_kde()
-		response = jsonify({
-				"statusCode": 200,
-				"kde": kde.tolist()
-			})
+		format_name = transport.negotiate(request.headers.get('Accept', ''), request.args.get('format'), transport.GRID_FORMATS)
+		compress = 'gzip' in request.headers.get('Accept-Encoding', '')
+		representation = '-' + format_name + ('-gzip' if compress else '')
+		response = not_modified('kde-' + mission.uid + '-' + str(mission.get_versioned_kde()[0]) + representation)
+		if response == None:
+			data, version = mission.get_kde_encoded(format_name, compress)
+			response = grid_response(data, format_name, compress, 'kde-' + mission.uid + '-' + str(version) + representation)
+			response.headers['X-Snapshot-Version'] = str(version)
+		response.headers['Vary'] = 'Accept, Accept-Encoding'
+		response.headers.add('Access-Control-Allow-Origin', '*')
+		return response
+
+@ns_mission.route("/kde_forecast")
+class MainClass(Resource):
+	def get(self):
+		forecast, pending = simulation.get_forecast()
+		etag = 'kde_forecast-' + mission.uid + '-' + '-'.join(str(horizon) + ':' + str(forecast[horizon][0]) for horizon in sorted(forecast)) + \
+			('-pending' if pending else '')
+		response = not_modified(etag)
+		if response == None:
+			kde_forecast = mission.get_kde_forecast(forecast)
+			response = tagged(jsonify({
+					"statusCode": 200,
+					"forecast": [{
+							"horizon": horizon,
+							"valid_time": valid_time.isoformat(),
+							"kde": kde.tolist()
+						} for horizon, (valid_time, kde) in sorted(kde_forecast.items())],
+					"pending": pending
+				}), etag)
 		response.headers.add('Access-Control-Allow-Origin', '*')
 		return response
 
 @ns_mission.route("/env_sensibility")
+@ns_mission.param('format', 'json (default), f32, u16 or u8 (binary grid, see transport.encode_grid). Also negotiated with the Accept header')
 class MainClass(Resource):
 	def get(self):
-		env_sensibility = mission.get_env_sensibility()
+		format_name = transport.negotiate(request.headers.get('Accept', ''), request.args.get('format'), transport.GRID_FORMATS)
+		compress = 'gzip' in request.headers.get('Accept-Encoding', '')
+		etag = 'env_sensibility-' + mission.uid + '-' + format_name + ('-gzip' if compress else '')
+		response = not_modified(etag)
+		if response == None:
+			data = mission.get_env_sensibility_encoded(format_name, compress)
+			response = grid_response(data, format_name, compress, etag)
+		response.headers['Vary'] = 'Accept, Accept-Encoding'
+		response.headers.add('Access-Control-Allow-Origin', '*')
+		return response
+
+@ns_simulation.route('/isl')
+class MainClass(Resource):
+	def get(self):
+		etag = 'isl-' + simulation.uid
+		response = not_modified(etag)
+		if response == None:
+			isl = simulation.get_isl()
+			response = tagged(jsonify({
+					"statusCode": 200,
+					"isl": isl.tolist()
+				}), etag)
+		
+		response.headers.add('Access-Control-Allow-Origin', '*')
+		return response
+
+@ns_simulation.route('/scheduler')
+class MainClass(Resource):
+	def get(self):
+		schedulers = []
+		if simulation != None:
+			schedulers.append(simulation.get_scheduler_stats())
+		if weatherConditions != None:
+			schedulers.append(weatherConditions.get_scheduler_stats())
 		response = jsonify({
 				"statusCode": 200,
-				"env_sensibility": env_sensibility.tolist()
+				"schedulers": schedulers
 			})
+		
 		response.headers.add('Access-Control-Allow-Origin', '*')
 		return response
 
-@ns_simulation.route('/isl')
+@ns_simulation.route('/particles/history')
+@ns_simulation.param('t', 'Step time (unix seconds or ISO format), latest step at or before it is returned. If blank, available steps are listed')
 class MainClass(Resource):
 	def get(self):
-		isl = simulation.get_isl()
+		t = request.args.get('t', '')
+		if t == '':
+			steps = simulation.get_history_steps()
+			response = jsonify({
+					"statusCode": 200,
+					"steps": [step.isoformat() for step in steps]
+				})
+		else:
+			try:
+				t = float(t)
+			except ValueError:
+				try:
+					t = calendar.timegm(datetime.fromisoformat(t).timetuple())
+				except ValueError as error:
+					t = None
+					response = jsonify({
+							"statusCode": 400,
+							"status": "Invalid time, expected unix seconds or ISO format",
+							"error": str(error)
+						})
+			if t != None:
+				step_time, particles, status = simulation.get_particles_history(t)
+				if step_time == None:
+					response = jsonify({
+							"statusCode": 404,
+							"status": "No particles history at or before requested time"
+						})
+				else:
+					response = jsonify({
+							"statusCode": 200,
+							"step_time": step_time.isoformat(),
+							"particles": particles.tolist(),
+							"status": status.tolist()
+						})
+		
+		response.headers.add('Access-Control-Allow-Origin', '*')
+		return response
+
+@ns_simulation.route('/render')
+class MainClass(Resource):
+	def post(self):
+		queued = simulation.request_frame()
 		response = jsonify({
-				"statusCode": 200,
-				"isl": isl.tolist()
+				"statusCode": 200 if queued else 503,
+				"status": "Frame requested" if queued else "Render queue is full"
 			})
 		
 		response.headers.add('Access-Control-Allow-Origin', '*')
 		return response
 
+@ns_simulation.route('/frame')
+class MainClass(Resource):
+	def get(self):
+		frame_file, frame_time = simulation.get_frame()
+		if frame_file == None:
+			response = jsonify({
+					"statusCode": 404,
+					"status": "No frame rendered, request one with /simulation/render"
+				})
+		else:
+			response = send_file(frame_file, mimetype='image/png', max_age=0)
+			response.headers.add('X-Step-Time', frame_time.isoformat())
+		
+		response.headers.add('Access-Control-Allow-Origin', '*')
+		return response
+
+@ns_simulation.route('/tiles/<string:layer>/<int:z>/<int:x>/<int:y>')
+@ns_simulation.param('layer', 'particles (particles count) or kde (mission KDE)')
+class MainClass(Resource):
+	def get(self, layer, z, x, y):
+		compress = 'gzip' in request.headers.get('Accept-Encoding', '')
+		encoding = '-gzip' if compress else ''
+		response = not_modified('tile-' + str(simulation.snapshot.version) + encoding)
+		if response != None:
+			response.headers['Vary'] = 'Accept-Encoding'
+		else:
+			data, version = simulation.get_tile(layer, z, x, y, compress)
+			if data == None:
+				response = jsonify({
+						"statusCode": 404,
+						"status": "No such tile"
+					})
+			else:
+				response = tagged(make_response(data), 'tile-' + str(version) + encoding)
+				response.headers['Content-Type'] = 'application/json'
+				if compress:
+					response.headers['Content-Encoding'] = 'gzip'
+				response.headers['Vary'] = 'Accept-Encoding'
+				response.headers['X-Snapshot-Version'] = str(version)
+		
+		response.headers.add('Access-Control-Allow-Origin', '*')
+		return response
+
 @ns_simulation.route("/particles/minLon:<minLon>&maxLon:<maxLon>&minLat:<minLat>&maxLat:<maxLat>")
 @ns_simulation.param('minLon', 'Min Longitude')
 @ns_simulation.param('maxLon', 'Max Longitude')
 @ns_simulation.param('minLat', 'Min Latitude')
 @ns_simulation.param('maxLat', 'Max Latitude')
+@ns_simulation.param('format', 'json (default), f32 (float32 little-endian lon then lat) or delta (quantized deltas). Also negotiated with the Accept header')
 class MainClass(Resource):
 	def get(self, minLon, maxLon, minLat, maxLat):
-		particles = simulation.get_particles(float(minLon), float(maxLon), float(minLat), float(maxLat))
-		response = jsonify({
-				"statusCode": 200,
-				"particles": particles.tolist()
-			})
+		format_name = transport.negotiate(request.headers.get('Accept', ''), request.args.get('format'))
+		compress = 'gzip' in request.headers.get('Accept-Encoding', '')
+		representation = '-' + format_name + ('-gzip' if compress else '')
+		response = not_modified('particles-' + str(simulation.snapshot.version) + representation)
+		if response == None:
+			data, version = simulation.get_particles_encoded(float(minLon), float(maxLon), float(minLat), float(maxLat), format_name, compress)
+			response = tagged(make_response(data), 'particles-' + str(version) + representation)
+			response.headers['Content-Type'] = transport.FORMATS[format_name]
+			if compress:
+				response.headers['Content-Encoding'] = 'gzip'
+			response.headers['X-Snapshot-Version'] = str(version)
+		response.headers['Vary'] = 'Accept, Accept-Encoding'
 		
 		response.headers.add('Access-Control-Allow-Origin', '*')
 		return response
@@ -319,38 +512,49 @@ class MainClass(Resource):
 @ns_mission.route("/robots_pos")
 class MainClass(Resource):
 	def get(self):
-		robots_pos = mission.get_robots_pos()
-		robots_heading = mission.get_robots_heading()
-		response = jsonify({
-				"statusCode": 200,
-				"robots_pos": robots_pos.tolist(),
-				"robots_heading": robots_heading.tolist()
-			})
+		# Version read first, positions newer than their tag are only sent again
+		etag = 'robots_pos-' + mission.uid + '-' + str(mission.robots_version)
+		response = not_modified(etag)
+		if response == None:
+			robots_pos = mission.get_robots_pos()
+			robots_heading = mission.get_robots_heading()
+			response = tagged(jsonify({
+					"statusCode": 200,
+					"robots_pos": robots_pos.tolist(),
+					"robots_heading": robots_heading.tolist()
+				}), etag)
 		response.headers.add('Access-Control-Allow-Origin', '*')
 		return response
 
 @ns_mission.route("/robots_lon_lat")
 class MainClass(Resource):
 	def get(self):
-		robots_lon_lat = mission.get_robots_lon_lat()
-		robots_heading = mission.get_robots_heading()
-		response = jsonify({
-				"statusCode": 200,
-				"robots_lon_lat": robots_lon_lat.tolist(),
-				"robots_heading": robots_heading.tolist()
-			})
+		# Version read first, positions newer than their tag are only sent again
+		etag = 'robots_lon_lat-' + mission.uid + '-' + str(mission.robots_version)
+		response = not_modified(etag)
+		if response == None:
+			robots_lon_lat = mission.get_robots_lon_lat()
+			robots_heading = mission.get_robots_heading()
+			response = tagged(jsonify({
+					"statusCode": 200,
+					"robots_lon_lat": robots_lon_lat.tolist(),
+					"robots_heading": robots_heading.tolist()
+				}), etag)
 		response.headers.add('Access-Control-Allow-Origin', '*')
 		return response
 
 @ns_mission.route('/region')
 class MainClass(Resource):
 	def get(self):
-		region, innerRegions = mission.get_region()
-		response = jsonify({
-				"statusCode": 200,
-				"region": region.tolist(),
-				"innerRegions": innerRegions
-			})
+		etag = 'region-' + mission.uid
+		response = not_modified(etag)
+		if response == None:
+			region, innerRegions = mission.get_region()
+			response = tagged(jsonify({
+					"statusCode": 200,
+					"region": region.tolist(),
+					"innerRegions": innerRegions
+				}), etag)
 		
 		response.headers.add('Access-Control-Allow-Origin', '*')
 		return response
@@ -358,11 +562,14 @@ class MainClass(Resource):
 @ns_mission.route('/robots_weights')
 class MainClass(Resource):
 	def get(self):
-		weights = mission.get_robots_weights()
-		response = jsonify({
-				"statusCode": 200,
-				"weights": weights.tolist()
-			})
+		etag = 'robots_weights-' + mission.uid
+		response = not_modified(etag)
+		if response == None:
+			weights = mission.get_robots_weights()
+			response = tagged(jsonify({
+					"statusCode": 200,
+					"weights": weights.tolist()
+				}), etag)
 		
 		response.headers.add('Access-Control-Allow-Origin', '*')
 		return response
\ No newline at end of file
@@ -0,0 +1,58 @@
+import os
+import shutil
+import time
+import uuid
+from contextlib import contextmanager
+
+VERSIONS_KEPT = 2     # Published versions of a file kept, readers may still have the previous one open
+
+def tmp_path(directory, ext=''):
+    # Unique hidden name in directory, so renaming it over a file there is atomic
+    return os.path.join(directory, '.tmp-' + uuid.uuid4().hex + ext)
+
+def _remove(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.exists(path):
+        os.remove(path)
+
+@contextmanager
+def atomic_write(path):
+    # Yields a temporary path (same directory and extension) to write path contents to, a file or a directory.
+    # It replaces path when the block completes and is removed if anything fails, so readers only ever see
+    # the previous or the complete new contents
+    tmp = tmp_path(os.path.dirname(os.path.abspath(path)), os.path.splitext(path)[1])
+    try:
+        yield tmp
+        os.replace(tmp, path)
+    finally:
+        _remove(tmp)
+
+def versioned_path(path):
+    # New version of path (name.<ns timestamp>.ext). Publishing under a new name never replaces a file
+    # readers hold open, which Windows refuses
+    base, ext = os.path.splitext(path)
+    return base + '.' + '%020d' % time.time_ns() + ext
+
+def _versions(path):
+    base, ext = os.path.splitext(path)
+    prefix = os.path.basename(base) + '.'
+    directory = os.path.dirname(path)
+    try:
+        names = os.listdir(directory or '.')
+    except OSError:
+        return []
+    return [os.path.join(directory, name) for name in sorted(names) \
+        if name.startswith(prefix) and name.endswith(ext) and name[len(prefix):len(name) - len(ext)].isdigit()]
+
+def latest_version(path):
+    # Newest published version of path, path itself if none was published
+    versions = _versions(path)
+    return versions[-1] if versions else path
+
+def remove_old_versions(path, keep=VERSIONS_KEPT):
+    for old in _versions(path)[:-keep]:
+        try:
+            os.remove(old)
+        except OSError:
+            pass    # Still open (Windows), removed after a later version
@@ -0,0 +1,80 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from atomic_file import atomic_write
+
+DOWNLOAD_WORKERS = 2            # Concurrent downloads (one per weather dataset)
+DOWNLOAD_RETRIES = 4            # Attempts after the first one
+DOWNLOAD_BACKOFF = 2.0          # Wait before first retry (seconds), doubled on each retry
+DOWNLOAD_TIMEOUT = (10, 120)    # Connect and read timeouts (seconds)
+CHUNK_SIZE = 1024 * 1024
+
+class DownloadManager(object):
+    def __init__(self, workers=DOWNLOAD_WORKERS, retries=DOWNLOAD_RETRIES, backoff=DOWNLOAD_BACKOFF, timeout=DOWNLOAD_TIMEOUT):
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+        # Connections are kept alive and reused between downloads
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+
+    def fetch(self, url, filename):
+        # Downloads url to filename, retrying transient failures. The file is replaced only by a complete download
+        wait = self.backoff
+        for attempt in range(self.retries + 1):
+            try:
+                self._download(url, filename)
+                return
+            except requests.HTTPError as error:
+                # Client errors will not go away by retrying
+                status = error.response.status_code
+                if (status < 500 and status != 429) or attempt == self.retries:
+                    raise
+                print('[DOWNLOAD] ' + url + ' failed (' + str(error) + '), retrying in ' + str(wait) + 's')
+            except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as error:
+                if attempt == self.retries:
+                    raise
+                print('[DOWNLOAD] ' + url + ' failed (' + str(error) + '), retrying in ' + str(wait) + 's')
+            time.sleep(wait)
+            wait *= 2
+
+    def _download(self, url, filename):
+        # Streaming to a temporary file in the same directory, then renaming it over the old file
+        with atomic_write(filename) as tmp:
+            with self.session.get(url, stream=True, allow_redirects=True, timeout=self.timeout) as r:
+                r.raise_for_status()
+                with open(tmp, 'wb') as tmpFile:
+                    for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                        tmpFile.write(chunk)
+                    tmpFile.flush()
+                    os.fsync(tmpFile.fileno())
+
+                # Older urllib3 accepts a connection closed before Content-Length bytes as a complete body
+                expected = r.headers.get('Content-Length')
+                if expected is not None and r.raw.tell() != int(expected):
+                    raise requests.exceptions.ChunkedEncodingError('Connection closed after ' + str(r.raw.tell()) + \
+                        ' of ' + expected + ' bytes')
+
+    def fetch_all(self, downloads):
+        # Downloads [(url, filename)] concurrently, returns {filename: error} for the failed ones
+        futures = [(filename, self._executor.submit(self.fetch, url, filename)) for url, filename in downloads]
+        errors = {}
+        for filename, future in futures:
+            try:
+                future.result()
+            except Exception as error:
+                errors[filename] = error
+        return errors
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self.session.close()
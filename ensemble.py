@@ -0,0 +1,102 @@
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+
+import numpy as np
+
+from forecast import worker_gnome
+from gnome_interface import DIFFUSION_COEF, WIND_SCALE, CURRENT_SCALE
+
+ENSEMBLE_MEMBERS = 1            # Members including the control run, 1 disables the ensemble
+ENSEMBLE_WORKERS = max((os.cpu_count() or 1) - 1, 1)   # One core is left to the control run
+ENSEMBLE_SEED = 0
+STEP_DURATION = 5 * 60          # Member step (seconds), same as the live step
+
+# Relative spread of the perturbed parameters, members draw uniformly in [1 - spread, 1 + spread]
+DIFFUSION_SPREAD = 0.5
+WIND_SCALE_SPREAD = 0.25
+CURRENT_SCALE_SPREAD = 0.2
+
+def member_parameters(n_members, seed=ENSEMBLE_SEED):
+    # (diffusion_coef, wind_scale, current_scale) of each member, member 0 is the unperturbed control run
+    rng = np.random.default_rng(seed)
+    parameters = [(DIFFUSION_COEF, WIND_SCALE, CURRENT_SCALE)]
+    for i in range(1, n_members):
+        parameters.append((DIFFUSION_COEF * rng.uniform(1 - DIFFUSION_SPREAD, 1 + DIFFUSION_SPREAD),
+            WIND_SCALE * rng.uniform(1 - WIND_SCALE_SPREAD, 1 + WIND_SCALE_SPREAD),
+            CURRENT_SCALE * rng.uniform(1 - CURRENT_SCALE_SPREAD, 1 + CURRENT_SCALE_SPREAD)))
+    return parameters
+
+def run_member(north, south, east, west, start_time, lon, lat, member, parameters):
+    diffusion_coef, wind_scale, current_scale = parameters
+    return worker_gnome(north, south, east, west).member_step(member, start_time, lon, lat, timedelta(seconds=STEP_DURATION), \
+        diffusion_coef=diffusion_coef, wind_scale=wind_scale, current_scale=current_scale)
+
+class Ensemble(object):
+    # Perturbed members 1..n-1, stepped in worker processes. The control member (0) is the live GNOME model.
+    # Each member is pinned to one worker, which keeps its model between steps
+    def __init__(self, north, south, east, west, n_members=ENSEMBLE_MEMBERS, workers=ENSEMBLE_WORKERS):
+        self.north = north
+        self.south = south
+        self.east = east
+        self.west = west
+        self.n_members = n_members
+        self.parameters = member_parameters(n_members)
+        self.workers = min(workers, max(n_members - 1, 1))
+
+        self._executors = []    # Single process executors, member i runs on self._executors[(i - 1) % workers]
+        self._futures = []      # Member steps not gathered yet
+        self._new_lon = []
+        self._new_lat = []
+
+    def add_oil(self, lon, lat):
+        # Reported oil is released in every member on next step
+        self._new_lon.append(np.atleast_1d(np.asarray(lon, dtype='float64')))
+        self._new_lat.append(np.atleast_1d(np.asarray(lat, dtype='float64')))
+
+    def submit(self, start_time, lon, lat, member):
+        # Starts the step of every perturbed member from its own particles, returns the pending results
+        if self.n_members <= 1:
+            return []
+        if len(self._executors) == 0:
+            self._executors = [ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) \
+                for _ in range(self.workers)]
+
+        new_lon = np.concatenate(self._new_lon) if len(self._new_lon) > 0 else np.array([])
+        new_lat = np.concatenate(self._new_lat) if len(self._new_lat) > 0 else np.array([])
+        self._new_lon = []
+        self._new_lat = []
+
+        pending = []
+        for i in range(1, self.n_members):
+            in_member = member == i
+            lon_i = np.concatenate([lon[in_member], new_lon])
+            lat_i = np.concatenate([lat[in_member], new_lat])
+            future = self._executors[(i - 1) % self.workers].submit(run_member, self.north, self.south, self.east, self.west, start_time, lon_i, lat_i, i, self.parameters[i])
+            pending.append((future, lon_i, lat_i))
+        self._futures = [future for future, _, _ in pending]
+        return pending
+
+    def gather(self, pending):
+        # Particles of the perturbed members, with member number. A failed member keeps its particles unmoved
+        lon = [np.array([])]
+        lat = [np.array([])]
+        member = [np.array([], dtype='uint16')]
+        for i, (future, lon_i, lat_i) in enumerate(pending):
+            try:
+                lon_i, lat_i = future.result()
+            except Exception as error:
+                print('[ENSEMBLE] Member ' + str(i + 1) + ' step failed: ' + str(error))
+            lon.append(lon_i)
+            lat.append(lat_i)
+            member.append(np.full(len(lon_i), i + 1, dtype='uint16'))
+        return np.concatenate(lon), np.concatenate(lat), np.concatenate(member)
+
+    def stop(self):
+        for future in self._futures:
+            future.cancel()
+        self._futures = []
+        for executor in self._executors:
+            executor.shutdown(wait=False)
+        self._executors = []
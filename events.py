@@ -0,0 +1,45 @@
+import json
+import threading
+from collections import deque
+
+EVENT_HISTORY = 256         # Events kept for clients reconnecting with Last-Event-ID
+KEEPALIVE_INTERVAL = 15     # Seconds without events before a keepalive comment is sent
+
+class EventBus(object):
+    # Simulation and mission changes ('step', 'kde', 'mission', 'robots'), streamed to clients as server-sent events
+    def __init__(self, history=EVENT_HISTORY):
+        self._events = deque(maxlen=history)
+        self._last_id = 0
+        self._condition = threading.Condition()
+
+    def publish(self, kind, data):
+        with self._condition:
+            self._last_id += 1
+            self._events.append((self._last_id, kind, data))
+            self._condition.notify_all()
+
+    def last_id(self):
+        with self._condition:
+            return self._last_id
+
+    def _after(self, last_id):
+        return [e for e in self._events if e[0] > last_id]
+
+    def stream(self, last_id=None, keepalive=KEEPALIVE_INTERVAL):
+        # Server-sent events text, starting after last_id (only new events if None)
+        if last_id is None:
+            last_id = self.last_id()
+        yield 'retry: 3000\n\n'
+        while True:
+            with self._condition:
+                events = self._after(last_id)
+                if len(events) == 0:
+                    self._condition.wait(keepalive)
+                    events = self._after(last_id)
+
+            if len(events) == 0:
+                yield ': keepalive\n\n'
+                continue
+            for event_id, kind, data in events:
+                yield 'id: ' + str(event_id) + '\nevent: ' + kind + '\ndata: ' + json.dumps(data) + '\n\n'
+                last_id = event_id
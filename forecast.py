@@ -0,0 +1,124 @@
+import os
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+
+import numpy as np
+
+from atomic_file import latest_version
+
+FORECAST_HORIZONS = [1 * 60 * 60, 3 * 60 * 60, 6 * 60 * 60]         # Forecast horizons (seconds)
+FORECAST_WORKERS = max(min(len(FORECAST_HORIZONS), (os.cpu_count() or 1) - 1), 1)  # One core is left to the live step
+
+WEATHER_FILES = ['./assets/currents.nc', './assets/wind.nc']
+
+# GNOME interface of the worker process, the map is loaded once per worker
+_gnome = None
+
+def worker_gnome(north, south, east, west):
+    global _gnome
+    if _gnome is None or (_gnome.north, _gnome.south, _gnome.east, _gnome.west) != (north, south, east, west):
+        # Imported here so only worker processes load GNOME
+        from gnome_interface import GnomeInterface
+        _gnome = GnomeInterface(north, south, east, west)
+    return _gnome
+
+def run_forecast(north, south, east, west, start_time, lon, lat, horizon):
+    return worker_gnome(north, south, east, west).forecast(start_time, lon, lat, horizon)
+
+def _weather_signature():
+    signature = []
+    for filename in WEATHER_FILES:
+        try:
+            filename = latest_version(filename)
+            stat = os.stat(filename)
+            signature.append((filename, stat.st_ino, stat.st_size, stat.st_mtime_ns))
+        except OSError:
+            signature.append(None)
+    return signature
+
+class Forecaster(object):
+    def __init__(self, north, south, east, west, horizons=FORECAST_HORIZONS, workers=FORECAST_WORKERS):
+        self.north = north
+        self.south = south
+        self.east = east
+        self.west = west
+        self.horizons = horizons
+        self.workers = workers
+
+        self._executor = None
+        self._lock = threading.RLock()
+
+        # Every run gets a new version. A horizon keeps the result of the latest run that completed it
+        # until a newer run replaces it
+        self.version = 0
+        self._inputs = None         # (start_time, lon, lat) of the latest run
+        self._weather = None        # Weather files signature of the latest run
+        self._results = {}          # horizon -> (version, valid time, lon, lat)
+        self._completed = {}        # horizon -> version of the latest run that finished it (result or error)
+        self._futures = []          # Submitted jobs not finished yet
+
+    def _submit(self):
+        # Called with self._lock held
+        if self._executor is None:
+            # Spawned workers do not inherit the server threads and GNOME state
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+
+        # Jobs of superseded runs still queued are dropped so the queue does not grow when a run is slower
+        # than the live step. Running ones finish and publish under their own version, so long horizons
+        # still get results
+        self._cancel()
+
+        self.version += 1
+        self._weather = _weather_signature()
+        start_time, lon, lat = self._inputs
+        for horizon in self.horizons:
+            future = self._executor.submit(run_forecast, self.north, self.south, self.east, self.west, start_time, lon, lat, horizon)
+            future.add_done_callback(lambda f, version=self.version, start_time=start_time, horizon=horizon: \
+                self._done(f, version, start_time, horizon))
+            self._futures.append(future)
+
+    def _cancel(self):
+        self._futures = [future for future in self._futures if not future.cancel() and not future.done()]
+
+    def _done(self, future, version, start_time, horizon):
+        if future.cancelled():
+            return
+        try:
+            lon, lat = future.result()
+        except Exception as error:
+            print('[FORECAST] Could not compute forecast +' + str(horizon) + 's: ' + str(error))
+            lon = lat = None
+
+        with self._lock:
+            if version < self._completed.get(horizon, 0):
+                return      # A newer run finished first
+            self._completed[horizon] = version
+            if lon is not None:
+                self._results[horizon] = (version, start_time + timedelta(seconds=horizon), lon, lat)
+
+    def update(self, start_time, lon, lat):
+        # New live step, forecasts are recomputed from its particles
+        with self._lock:
+            self._inputs = (start_time, np.array(lon), np.array(lat))
+            self._submit()
+
+    def get(self):
+        # Latest finished forecast of each horizon, rerun first if weather files changed since
+        with self._lock:
+            if self._inputs is not None and _weather_signature() != self._weather:
+                self._submit()
+            return dict(self._results)
+
+    def pending(self):
+        with self._lock:
+            # Horizons the latest run has not finished yet
+            return [h for h in self.horizons if self._completed.get(h, 0) < self.version]
+
+    def stop(self):
+        with self._lock:
+            if self._executor is not None:
+                self._cancel()
+                self._executor.shutdown(wait=False)
+                self._executor = None
@@ -0,0 +1,79 @@
+import os
+import queue
+import threading
+
+import numpy as np
+
+from gnome.outputters import Renderer
+
+from atomic_file import atomic_write
+
+RENDER_QUEUE_SIZE = 2   # Pending frame requests, further requests are refused until the worker catches up
+
+class FrameRenderer(object):
+    def __init__(self, mapfile, output_dir, viewport, image_size=(900, 600), queue_size=RENDER_QUEUE_SIZE):
+        self.mapfile = mapfile
+        self.output_dir = output_dir
+        self.viewport = viewport
+        self.image_size = image_size
+
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self._canvas = None
+
+        self.background_file = os.path.join(output_dir, 'background_map.png')
+        self.frame_file = os.path.join(output_dir, 'foreground_latest.png')
+        self.frame_time = None   # Step time of the latest rendered frame
+
+    def request(self, lon, lat, step_time):
+        # Queue a frame for the given particles snapshot, False if the queue is full
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._worker, daemon=True)
+            self._thread.start()
+
+        try:
+            self._queue.put_nowait((np.array(lon), np.array(lat), step_time))
+            return True
+        except queue.Full:
+            return False
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            try:
+                self._render(*job)
+            except Exception as error:
+                print('[RENDER] Could not render frame: ' + str(error))
+
+    def _render(self, lon, lat, step_time):
+        # Land background is drawn once, frames only draw the particles on top of it
+        if self._canvas is None:
+            os.makedirs(self.output_dir, exist_ok=True)
+            self._canvas = Renderer(self.mapfile, self.output_dir, image_size=self.image_size)
+            self._canvas.viewport = self.viewport
+            self._canvas.draw_background()
+            self._canvas.save_background(self.background_file)
+
+        self._canvas.clear_foreground()
+        if len(lon) > 0:
+            self._canvas.draw_points(np.column_stack([lon, lat]), diameter=2, color='black', shape='round')
+
+        with atomic_write(self.frame_file) as tmp_file:
+            self._canvas.save_foreground(tmp_file)
+        self.frame_time = step_time
+
+    def stop(self):
+        if self._thread is not None:
+            # Dropping pending frames so the stop request fits in the queue
+            while True:
+                try:
+                    self._queue.put_nowait(None)
+                    break
+                except queue.Full:
+                    try:
+                        self._queue.get_nowait()
+                    except queue.Empty:
+                        pass
+            self._thread = None
@@ -0,0 +1,125 @@
+import hashlib
+import os
+
+import numpy as np
+from shapely import geometry
+import shapefile
+
+from atomic_file import atomic_write
+
+CACHE_DIR = './assets/cache/geodata'
+BNA_MARGIN = None   # Land polygons farther than this (degrees) from the simulation area are dropped, None keeps the whole coastline
+
+def _source_key(filenames, *params):
+    # Identifies source files by path, size and modification time, so changed sources invalidate the cache
+    sha = hashlib.sha1()
+    for filename in filenames:
+        stat = os.stat(filename)
+        sha.update(repr((os.path.abspath(filename), stat.st_size, stat.st_mtime_ns)).encode())
+    sha.update(repr(params).encode())
+    return sha.hexdigest()[:16]
+
+def _cache_path(name, key, ext):
+    return os.path.join(CACHE_DIR, name + '-' + key + ext)
+
+def _publish(path, write):
+    # Writing to a temporary file and renaming it, then removing older versions of the same entry
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with atomic_write(path) as tmp:
+        write(tmp)
+
+    prefix = os.path.basename(path).rsplit('-', 1)[0] + '-'
+    for filename in os.listdir(CACHE_DIR):
+        if filename.startswith(prefix) and filename != os.path.basename(path):
+            try:
+                os.remove(os.path.join(CACHE_DIR, filename))
+            except OSError:
+                pass
+
+def _cached_array(name, sources, params, build):
+    path = _cache_path(name, _source_key(sources, *params), '.npy')
+    if os.path.exists(path):
+        return np.load(path)
+
+    array = build()
+    _publish(path, lambda tmp: np.save(tmp, array))
+    return array
+
+def _shp_sources(filename):
+    base = os.path.splitext(filename)[0]
+    return [f for f in (base + '.shp', base + '.dbf', base + '.shx') if os.path.exists(f)]
+
+def load_isl(filename, encoding='ISO8859-1'):
+    # ISL centroids as [lon, lat, isl_value] for features with isl value > 0
+    def build():
+        isl_shp = shapefile.Reader(filename, encoding=encoding)
+        isl_attr = np.array(isl_shp.records())[:, 0] # Gets only isl value
+        isl_features = isl_shp.shapeRecords()
+        isl = []
+        for i in range(len(isl_features)):
+            # Each feature has a geo_interface with a list of coordinates representing an ISL value
+            if (isl_attr[i] > 0):
+                geo = isl_features[i].shape.__geo_interface__
+                if (geo['type'] == 'LineString'):
+                    mean_lon, mean_lat = np.mean(np.array(geo['coordinates']), axis = 0)
+                elif (geo['type'] == 'MultiLineString'):
+                    mean_lon, mean_lat = np.mean(np.vstack(geo['coordinates']), axis = 0)
+                else:
+                    print('Unknown type: ' + geo['type'])
+                    continue
+                isl.append([mean_lon, mean_lat, isl_attr[i]])
+        return np.array(isl, dtype='float64').reshape((-1, 3))
+
+    return _cached_array('isl', _shp_sources(filename), (encoding,), build)
+
+def load_coastline(filename):
+    # Exterior coordinates of the first shape in the coastline shapefile
+    def build():
+        shpfile = shapefile.Reader(filename)
+        feature = shpfile.shapeRecords()[0]
+        shp = geometry.shape(feature.shape.__geo_interface__)
+        return np.array(shp.exterior.coords)
+
+    return _cached_array('coastline', _shp_sources(filename), (), build)
+
+def prepared_bna(filename, north, south, east, west, margin=BNA_MARGIN):
+    # Normalized BNA map (cached). Cropping is opt-in: with a margin only the polygons near the simulation area are kept,
+    # so GNOME rasterizes less land, but particles reaching dropped land would not beach there
+    key = _source_key([filename], north, south, east, west, margin)
+    path = _cache_path(os.path.splitext(os.path.basename(filename))[0], key, '.bna')
+    if os.path.exists(path):
+        return path
+
+    with open(filename) as bnaFile:
+        lines = bnaFile.read().splitlines()
+
+    kept = []
+    i = 0
+    while i < len(lines):
+        header = lines[i]
+        if header.strip() == '':
+            i += 1
+            continue
+        fields = [f.strip().strip('"') for f in header.split(',')]
+        n_points = abs(int(fields[-1]))
+        points = lines[i + 1:i + 1 + n_points]
+        i += 1 + n_points
+
+        # Map bounds and spillable area polygons are always kept, land too unless cropping
+        if margin is None or fields[0] in ('Map Bounds', 'SpillableArea'):
+            kept.append(header)
+            kept.extend(points)
+            continue
+
+        coords = np.array([[float(v) for v in p.split(',')[0:2]] for p in points])
+        if np.max(coords[:, 0]) >= west - margin and np.min(coords[:, 0]) <= east + margin and \
+            np.max(coords[:, 1]) >= south - margin and np.min(coords[:, 1]) <= north + margin:
+            kept.append(header)
+            kept.extend(points)
+
+    def write(tmp):
+        with open(tmp, 'w') as preparedFile:
+            preparedFile.write('\n'.join(kept) + '\n')
+
+    _publish(path, write)
+    return path
@@ -18,7 +18,7 @@ from gnome.spill import (point_line_release_spill,
                          InitElemsFromFile,
                          Spill)
 
-from gnome.spill.release import release_from_splot_data
+from gnome.spill.release import release_from_splot_data, SpatialRelease
 
 
 from gnome.spill_container import SpillContainer
@@ -33,15 +33,43 @@ from gnome.utilities.distributions import UniformDistribution
 
 from gnome.movers import RandomMover, GridCurrentMover,  GridWindMover
 
-from gnome.outputters import Renderer
 from gnome.outputters import NetCDFOutput
 
 from gnome import utilities
 
-import netCDF4 as nc
+from atomic_file import latest_version
+from geodata_cache import prepared_bna
+
+DEBUG_OUTPUT = False    # Also write step.txt/step.nc files (particles are handed over in memory)
+FORECAST_TIME_STEP = timedelta(minutes=15)  # Time step of forecast runs (live steps are 5 minutes)
+
+CURRENTS_FILE = './assets/currents.nc'
+WIND_FILE = './assets/wind.nc'
+
+DIFFUSION_COEF = 10000
+WIND_SCALE = 2
+CURRENT_SCALE = 1
+
+def create_current_mover(curr_file, current_scale=CURRENT_SCALE):
+    c_mover = GridCurrentMover(curr_file, num_method='Euler')
+    c_mover.current_scale = current_scale
+    return c_mover
+
+def create_wind_mover(wind_file, wind_scale=WIND_SCALE):
+    w_mover = GridWindMover(wind_file)
+    w_mover.uncertain_speed_scale = 1
+    w_mover.wind_scale = wind_scale
+    return w_mover
+
+def in_water_particles(sc):
+    # lon/lat of in water particles of a spill container
+    if sc.num_released == 0:
+        return np.array([]), np.array([])
+    in_water = np.where(sc['status_codes'] == 2)[0]
+    return np.array(sc['positions'][in_water, 0]), np.array(sc['positions'][in_water, 1])
 
 class GnomeInterface:
-    def __init__(self, north, south, east, west):
+    def __init__(self, north, south, east, west, debug_output=DEBUG_OUTPUT):
 
         self.north = north
         self.south = south
@@ -49,7 +77,8 @@ class GnomeInterface:
         self.west = west
 
         base_dir = os.path.dirname(__file__)
-        self.mapfile = get_datafile(os.path.join(base_dir, './assets/brazil-coast.bna'))
+        # Whole coastline map (cached, rebuilt when the bna file changes)
+        self.mapfile = prepared_bna(get_datafile(os.path.join(base_dir, './assets/brazil-coast.bna')), north, south, east, west)
         self.gnome_map = MapFromBNA(self.mapfile, refloat_halflife=6)
         
         oil_name = 'GENERIC MEDIUM CRUDE'
@@ -58,9 +87,19 @@ class GnomeInterface:
         
         self.new_oil = []
 
-        
-    def step(self, start_time):
-        print('Computing new gnome step')
+        # Particles carried over to the next step, seeded from step.txt on first step
+        self.debug_output = debug_output
+        self._carry_lon = None
+        self._carry_lat = None
+
+        # Long-lived model, movers are reloaded only when their weather files change
+        self.model = None
+        self._weather_movers = {}       # name -> (mover, weather file signature)
+
+        # Long-lived models of the ensemble members stepped by this instance (worker processes)
+        self._members = {}              # (member, parameters) -> (model, weather movers)
+
+    def _build_model(self, start_time):
         base_dir = os.path.dirname(__file__)
 
         model = Model(start_time=start_time, 
@@ -69,79 +108,176 @@ class GnomeInterface:
             map=self.gnome_map,
             uncertain=False,
             cache_enabled=False)
+
+        model.movers += RandomMover(diffusion_coef=DIFFUSION_COEF)
+
+        # Map images are not rendered here, see FrameRenderer for on demand frames
+        if self.debug_output:
+            netcdf_file = os.path.join(base_dir, './assets/step.nc')
+            model.outputters += NetCDFOutput(netcdf_file, which_data='standard', surface_conc='kde')
+
+        return model
+
+    def _positions(self, lon, lat):
+        return np.column_stack([lon, lat, np.zeros(len(lon))])
+
+    def _file_signature(self, filename):
+        # Weather files are published as new versions, a different name means new data
+        stat = os.stat(filename)
+        return (filename, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+    def _update_weather_mover(self, model, weather_movers, name, filename, create_mover):
+        signature = self._file_signature(filename)
+        current = weather_movers.get(name)
+        if current is not None and current[1] == signature:
+            return
+
+        print('Loading ' + name + ' mover from ' + filename)
+        mover = create_mover(filename)
+        if current is not None:
+            del model.movers[current[0].id]
+        model.movers += mover
+        weather_movers[name] = (mover, signature)
+
+    def step(self, start_time):
+        print('Computing new gnome step')
+        base_dir = os.path.dirname(__file__)
+
+        if self.model is None:
+            self.model = self._build_model(start_time)
+        model = self.model
+        model.start_time = start_time
+
+        #curr_file = get_datafile(os.path.join(base_dir, './assets/corrente15a28de09.nc'))
+        curr_file = get_datafile(latest_version(os.path.join(base_dir, CURRENTS_FILE)))
+        self._update_weather_mover(model, self._weather_movers, 'currents', curr_file, create_current_mover)
+
+        #wind_file = get_datafile(os.path.join(base_dir, './assets/vento15a28de09.nc'))
+        wind_file = get_datafile(latest_version(os.path.join(base_dir, WIND_FILE)))
+        self._update_weather_mover(model, self._weather_movers, 'wind', wind_file, create_wind_mover)
+
+        # Releases from the previous step are replaced in the existing spill container
+        for spill in list(model.spills):
+            del model.spills[spill.id]
         
         # Add reported oil (at current time)
         if len(self.new_oil) > 0:
             for oil in self.new_oil:
-                release = SpartialRelease(release_time=start_time, start_position=oil)
+                release = SpatialRelease(release_time=start_time, start_position=oil)
                 model.spills += Spill(release=release, substance=self.subs)
             self.new_oil = []
 
         # Add already present oil particles
-        try:
-            f = open('./assets/step.txt')
-            f.close()
-            release = release_from_splot_data(start_time,
-                                            './assets/step.txt')
-            model.spills += Spill(release=release, substance=self.subs)        
-        except IOError:
+        if self._carry_lon is not None:
+            if len(self._carry_lon) > 0:
+                release = SpatialRelease(release_time=start_time, start_position=self._positions(self._carry_lon, self._carry_lat))
+                model.spills += Spill(release=release, substance=self.subs)
+        else:
+            try:
+                f = open('./assets/step.txt')
+                f.close()
+                release = release_from_splot_data(start_time,
+                                                './assets/step.txt')
+                model.spills += Spill(release=release, substance=self.subs)        
+            except IOError:
+                pass
+
+        if self.debug_output:
+            netcdf_file = os.path.join(base_dir, './assets/step.nc')
+            scripting.remove_netcdf(netcdf_file)
+
+        model.rewind()
+        for step in model:
             pass
+            #print "step: %.4i -- memuse: %fMB" % (step['step_num'], utilities.get_mem_use())
+        #model.full_run()
+        print('Computed new gnome step')
+
+    def get_particles(self):
+        # Particles straight from the model spill container after the last step, with their status codes
+        sc = self.model.spills.items()[0]
+        if sc.num_released == 0:
+            return np.array([]), np.array([]), np.array([], dtype='uint8')
 
-        model.movers += RandomMover(diffusion_coef=10000)
+        positions = sc['positions']
+        status_codes = sc['status_codes'] #'0: not_released, 2: in_water, 3: on_land, 7: off_maps, 10: evaporated, 12: to_be_removed, 32: on_tideflat,'
 
-        #curr_file = get_datafile(os.path.join(base_dir, './assets/corrente15a28de09.nc'))
-        curr_file = get_datafile(os.path.join(base_dir, './assets/currents.nc'))
-        model.movers += GridCurrentMover(curr_file, num_method='Euler')
+        return np.array(positions[:, 0]), np.array(positions[:, 1]), np.array(status_codes)
 
-        #wind_file = get_datafile(os.path.join(base_dir, './assets/vento15a28de09.nc'))
-        wind_file = get_datafile(os.path.join(base_dir, './assets/wind.nc'))
-        w_mover = GridWindMover(wind_file)
-        w_mover.uncertain_speed_scale = 1
-        w_mover.wind_scale = 2
-        model.movers += w_mover
-
-        renderer = Renderer(self.mapfile, os.path.join(base_dir, 'images'), image_size=(900, 600),
-            output_timestep=timedelta(minutes=5),
-            draw_ontop='forecast')
-        
-        renderer.viewport = ((self.west, self.south), (self.east, self.north)) #1/4 N alagoas
-        model.outputters += renderer
+    def forecast(self, start_time, lon, lat, horizon, time_step=FORECAST_TIME_STEP,
+        diffusion_coef=DIFFUSION_COEF, wind_scale=WIND_SCALE, current_scale=CURRENT_SCALE):
+        # Runs particles horizon seconds ahead on a throwaway model, the live model is not touched.
+        # Movers can be perturbed for ensemble members. Returns in water particles lon/lat at start_time + horizon
+        print('Computing forecast +' + str(horizon) + 's')
+        base_dir = os.path.dirname(__file__)
+
+        model = Model(start_time=start_time,
+            duration=timedelta(seconds=horizon),
+            time_step=time_step,
+            map=self.gnome_map,
+            uncertain=False,
+            cache_enabled=False)
+        model.movers += RandomMover(diffusion_coef=diffusion_coef)
+        model.movers += create_current_mover(get_datafile(latest_version(os.path.join(base_dir, CURRENTS_FILE))), current_scale)
+        model.movers += create_wind_mover(get_datafile(latest_version(os.path.join(base_dir, WIND_FILE))), wind_scale)
 
-        netcdf_file = os.path.join(base_dir, './assets/step.nc')
-        scripting.remove_netcdf(netcdf_file)
-        model.outputters += NetCDFOutput(netcdf_file, which_data='standard', surface_conc='kde')
+        if len(lon) == 0:
+            return np.array([]), np.array([])
+        release = SpatialRelease(release_time=start_time, start_position=self._positions(lon, lat))
+        model.spills += Spill(release=release, substance=self.subs)
 
         for step in model:
             pass
-            #print "step: %.4i -- memuse: %fMB" % (step['step_num'], utilities.get_mem_use())
-        #model.full_run()
-        print('Computed new gnome step')
+        print('Computed forecast +' + str(horizon) + 's')
 
-    def get_particles(self):
-        base_dir = os.path.dirname(__file__)
-        netcdf_file = os.path.join(base_dir, './assets/step.nc')
-        # read nc and prepare particles lat lon
-        data = nc.Dataset(netcdf_file)
-        lon = np.array(data['longitude'][:])
-        lat = np.array(data['latitude'][:])
-        status_codes = np.array(data['status_codes'][:]) #'0: not_released, 2: in_water, 3: on_land, 7: off_maps, 10: evaporated, 12: to_be_removed, 32: on_tideflat,'
-        pc = np.array(data['particle_count'][:]) #'1-number of particles in a given timestep'
-
-        lon = lon[len(lon) - pc[-1]:len(lon)]
-        lat = lat[len(lat) - pc[-1]:len(lat)]
-        status_codes = status_codes[len(status_codes) - pc[-1]:len(status_codes)]
-
-        lon = lon[np.where(status_codes == 2)]
-        lat = lat[np.where(status_codes == 2)]
-
-        return lon, lat
+        return in_water_particles(model.spills.items()[0])
     
+    def member_step(self, member, start_time, lon, lat, time_step,
+        diffusion_coef=DIFFUSION_COEF, wind_scale=WIND_SCALE, current_scale=CURRENT_SCALE):
+        # One step of an ensemble member (perturbed movers) on its own long-lived model, movers are reloaded
+        # only when their weather files change. Returns in water particles lon/lat at start_time + time_step
+        if len(lon) == 0:
+            return np.array([]), np.array([])
+        base_dir = os.path.dirname(__file__)
+
+        key = (member, diffusion_coef, wind_scale, current_scale)
+        if key not in self._members:
+            model = Model(start_time=start_time,
+                duration=time_step,
+                time_step=time_step,
+                map=self.gnome_map,
+                uncertain=False,
+                cache_enabled=False)
+            model.movers += RandomMover(diffusion_coef=diffusion_coef)
+            self._members[key] = (model, {})
+        model, weather_movers = self._members[key]
+        model.start_time = start_time
+
+        self._update_weather_mover(model, weather_movers, 'currents', get_datafile(latest_version(os.path.join(base_dir, CURRENTS_FILE))), \
+            lambda f: create_current_mover(f, current_scale))
+        self._update_weather_mover(model, weather_movers, 'wind', get_datafile(latest_version(os.path.join(base_dir, WIND_FILE))), \
+            lambda f: create_wind_mover(f, wind_scale))
+
+        for spill in list(model.spills):
+            del model.spills[spill.id]
+        release = SpatialRelease(release_time=start_time, start_position=self._positions(lon, lat))
+        model.spills += Spill(release=release, substance=self.subs)
+
+        model.rewind()
+        for step in model:
+            pass
+
+        return in_water_particles(model.spills.items()[0])
+
     def add_oil(self, lon, lat):
-        oil = np.array([[lon[i], lat[i]] for i in range(len(lon))])
+        oil = self._positions(lon, lat)
         self.new_oil.append(oil)
 
     def save_particles(self, lon, lat):
-        particles = np.array([[lon[i], lat[i], 1] for i in range(len(lon))])
-        np.savetxt('./assets/step.txt', particles)
-
+        # Particles released on next step
+        self._carry_lon = np.array(lon)
+        self._carry_lat = np.array(lat)
 
+        if self.debug_output:
+            particles = np.column_stack([lon, lat, np.ones(len(lon))])
+            np.savetxt('./assets/step.txt', particles)
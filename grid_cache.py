@@ -0,0 +1,86 @@
+import hashlib
+import os
+import shutil
+
+import numpy as np
+
+from atomic_file import atomic_write
+
+CACHE_DIR = './assets/cache/grids'
+CACHE_MAX_BYTES = 256 * 1024 * 1024     # Cache size limit, least recently used entries are evicted
+
+def file_signature(filename):
+    # Identifies a source file by path, size and modification time (same as the geodata cache), without reading it
+    stat = os.stat(filename)
+    return (os.path.abspath(filename), stat.st_size, stat.st_mtime_ns)
+
+class GridCache(object):
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    def key(self, *parts):
+        # Content address of the inputs the grids are derived from
+        sha = hashlib.sha256()
+        for part in parts:
+            if isinstance(part, np.ndarray):
+                sha.update(str(part.dtype).encode() + str(part.shape).encode())
+                sha.update(np.ascontiguousarray(part).tobytes())
+            else:
+                sha.update(repr(part).encode())
+            sha.update(b'|')
+        return sha.hexdigest()
+
+    def load(self, key):
+        # Returns cached grids memory-mapped (read only), None if not cached
+        entry = os.path.join(self.cache_dir, key)
+        if not os.path.isdir(entry):
+            return None
+
+        try:
+            grids = {}
+            for filename in os.listdir(entry):
+                if filename.endswith('.npy'):
+                    grids[filename[:-4]] = np.load(os.path.join(entry, filename), mmap_mode='r')
+        except (OSError, ValueError):
+            return None
+
+        # Marking entry as recently used
+        os.utime(entry)
+        return grids
+
+    def store(self, key, grids):
+        entry = os.path.join(self.cache_dir, key)
+        if os.path.isdir(entry):
+            return
+
+        # Writing to a temporary directory and renaming it, so readers never see a partial entry
+        os.makedirs(self.cache_dir, exist_ok=True)
+        try:
+            with atomic_write(entry) as tmp:
+                os.makedirs(tmp)
+                for name, grid in grids.items():
+                    np.save(os.path.join(tmp, name + '.npy'), np.ascontiguousarray(grid))
+        except OSError:
+            # Another process stored the same entry first
+            return
+
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            entry = os.path.join(self.cache_dir, name)
+            if name.startswith('.') or not os.path.isdir(entry):
+                continue
+            size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+            entries.append((os.path.getmtime(entry), size, entry))
+            total += size
+
+        # Removing least recently used entries until the cache fits
+        for _, size, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
@@ -0,0 +1,229 @@
+import numpy as np
+from scipy.signal import fftconvolve
+from scipy.spatial import cKDTree
+from shapely import vectorized
+
+def grid_points(min_lon, min_lat, width, height, res_grid):
+    # Lon/lat of every grid cell, indexed [j, i] as in the mission grid maps
+    lon = (np.arange(width)/res_grid) + min_lon
+    lat = (np.arange(height)/res_grid) + min_lat
+    return np.meshgrid(lon, lat)
+
+def bin_index(values, edges):
+    # First bin j with edges[j] <= value <= edges[j+1], values outside the edges go to bin 0
+    values = np.asarray(values)
+    idx = np.searchsorted(edges, values, side='left') - 1
+    idx[np.logical_not((values >= edges[0]) & (values <= edges[-1]))] = 0
+    return np.maximum(idx, 0)
+
+def _intersects(polygon, lon, lat):
+    # Same as polygon.intersects(Point(lon, lat)) for each point: interior or boundary
+    return np.logical_or(vectorized.contains(polygon, lon, lat), vectorized.touches(polygon, lon, lat))
+
+def rasterize_region(region_polygon, inner_polygons, min_lon, min_lat, width, height, res_grid):
+    lon, lat = grid_points(min_lon, min_lat, width, height, res_grid)
+    lon = lon.ravel()
+    lat = lat.ravel()
+
+    # Cells inside the region of interest polygon
+    fly_zone = _intersects(region_polygon, lon, lat)
+
+    # Removing cells inside inner cutoff polygons, only testing cells still in fly zone
+    for poly in inner_polygons:
+        candidates = np.where(fly_zone)[0]
+        if len(candidates) == 0:
+            break
+        fly_zone[candidates[_intersects(poly, lon[candidates], lat[candidates])]] = False
+
+    mask = np.logical_not(fly_zone).reshape((height, width)).astype('float64')
+    mask_idx = np.argwhere(mask.T == 0) # indexes of cells inside polygon
+
+    return mask, mask_idx
+
+class CoastDistance(object):
+    def __init__(self, coords, max_segment_factor=4.0):
+        self.vertices = np.asarray(coords, dtype='float64')[:, 0:2]
+        self._vertex_tree = cKDTree(self.vertices)
+
+        # Coast segments, long ones split so the midpoint search radius stays tight
+        start = self.vertices[:-1]
+        end = self.vertices[1:]
+        length = np.sqrt(np.sum((end - start)**2, axis=1))
+        max_length = max_segment_factor * np.median(length) if len(length) > 0 else 0
+        if max_length > 0:
+            pieces = np.maximum(np.ceil(length/max_length), 1).astype('int')
+        else:
+            pieces = np.ones(len(length), dtype='int')
+        seg = np.repeat(np.arange(len(length)), pieces)
+        first = np.cumsum(pieces) - pieces
+        k = np.arange(len(seg)) - np.repeat(first, pieces)
+        frac0 = (k / pieces[seg])[:, None]
+        frac1 = ((k + 1) / pieces[seg])[:, None]
+        step = end[seg] - start[seg]
+        self._seg_start = start[seg] + frac0 * step
+        self._seg_end = start[seg] + frac1 * step
+
+        if len(self._seg_start) > 0:
+            self._seg_half_length = np.max(np.sqrt(np.sum((self._seg_end - self._seg_start)**2, axis=1)))/2
+            self._seg_tree = cKDTree((self._seg_start + self._seg_end)/2)
+        else:
+            self._seg_half_length = 0
+            self._seg_tree = None
+
+    def query(self, lon, lat, mode='vertex'):
+        # Distance (degrees) from each point to the nearest coast vertex or coast segment
+        points = np.column_stack([np.ravel(lon), np.ravel(lat)])
+        vertex_dist, _ = self._vertex_tree.query(points)
+
+        if mode == 'vertex':
+            return vertex_dist
+        elif mode == 'segment':
+            return self._segment_dist(points, vertex_dist)
+        else:
+            raise ValueError('Unknown coast distance mode: ' + str(mode))
+
+    def _segment_dist(self, points, vertex_dist, k=8):
+        if self._seg_tree is None:
+            return vertex_dist
+
+        # Exact distance to the segments with the k nearest midpoints
+        k = min(k, self._seg_tree.n)
+        mid_dist, seg_idx = self._seg_tree.query(points, k=k)
+        mid_dist = mid_dist.reshape((len(points), k))
+        seg_idx = seg_idx.reshape((len(points), k))
+        dist = np.minimum(vertex_dist, np.min(self._point_segment_dist(np.repeat(points, k, axis=0), seg_idx.ravel()).reshape((len(points), k)), axis=1))
+
+        # Any other segment is at least its midpoint distance minus half a segment away,
+        # only points where that bound does not settle it need a radius search
+        unresolved = np.where(dist > mid_dist[:, -1] - self._seg_half_length)[0]
+        if len(unresolved) > 0:
+            candidates = self._seg_tree.query_ball_point(points[unresolved], dist[unresolved] + self._seg_half_length)
+            counts = np.fromiter((len(c) for c in candidates), dtype='int', count=len(candidates))
+            if np.sum(counts) > 0:
+                point_idx = np.repeat(unresolved, counts)
+                cand_idx = np.concatenate([c for c in candidates if len(c) > 0]).astype('int')
+                np.minimum.at(dist, point_idx, self._point_segment_dist(points[point_idx], cand_idx))
+
+        return dist
+
+    def _point_segment_dist(self, points, seg_idx):
+        a = self._seg_start[seg_idx]
+        ab = self._seg_end[seg_idx] - a
+        ap = points - a
+        ab_len2 = np.sum(ab**2, axis=1)
+        t = np.divide(np.sum(ap*ab, axis=1), ab_len2, out=np.zeros(len(ab_len2)), where=ab_len2 > 0)
+        t = np.clip(t, 0, 1)
+        return np.sqrt(np.sum((ap - t[:, None]*ab)**2, axis=1))
+
+class IslPotentialField(object):
+    def __init__(self, isl, sigma=0.1, cutoff=8.0):
+        self.isl = np.asarray(isl, dtype='float64').reshape((-1, 3)) # [lon, lat, isl_value]
+        self.sigma = sigma
+        self.radius = cutoff * sigma # Kernel is truncated beyond this distance
+        self._tree = cKDTree(self.isl[:, 0:2]) if len(self.isl) > 0 else None
+
+    def compute(self, min_lon, min_lat, width, height, res_grid):
+        lon = (np.arange(width)/res_grid) + min_lon
+        lat = (np.arange(height)/res_grid) + min_lat
+        potential_field = np.zeros((height, width))
+        if self._tree is None:
+            return potential_field
+
+        # ISLs whose truncated kernel can reach the grid
+        center = [(lon[0] + lon[-1])/2, (lat[0] + lat[-1])/2]
+        half_diag = np.sqrt((lon[-1] - lon[0])**2 + (lat[-1] - lat[0])**2)/2
+        near = self._tree.query_ball_point(center, half_diag + self.radius)
+        if len(near) == 0:
+            return potential_field
+        isl = self.isl[np.sort(near)]
+
+        # Gaussian kernel is separable: exp(-(dx^2 + dy^2)/(2 sigma^2)) = exp(-dx^2/(2 sigma^2)) * exp(-dy^2/(2 sigma^2))
+        dx = lon[None, :] - isl[:, 0:1]
+        dy = lat[None, :] - isl[:, 1:2]
+        gx = np.exp(-(dx**2)/(2 * self.sigma**2))
+        gy = np.exp(-(dy**2)/(2 * self.sigma**2))
+        gx[np.abs(dx) > self.radius] = 0
+        gy[np.abs(dy) > self.radius] = 0
+
+        # Sum over ISLs of Amp * gy[:, j] * gx[:, i] as a single matrix product
+        potential_field += np.dot((isl[:, 2:3] * gy).T, gx)
+
+        return potential_field
+
+class BinnedKDE(object):
+    def __init__(self, x_centers, y_centers, lon, lat, bw_method, cutoff=5.0):
+        # Evaluation lattice (uniformly spaced cell centers)
+        self.x0 = x_centers[0]
+        self.y0 = y_centers[0]
+        self.nx = len(x_centers)
+        self.ny = len(y_centers)
+        self.dx = (x_centers[-1] - x_centers[0])/(self.nx - 1) if self.nx > 1 else 1.0
+        self.dy = (y_centers[-1] - y_centers[0])/(self.ny - 1) if self.ny > 1 else 1.0
+
+        # Same bandwidth as scipy gaussian_kde: data covariance scaled by bw_method^2
+        self.n = len(lon)
+        self.covariance = np.atleast_2d(np.cov(np.vstack([lon, lat]), rowvar=1, bias=False)) * bw_method**2
+        self.kernel = self._build_kernel(cutoff)
+
+        self.density = np.zeros((self.ny, self.nx))
+        self.add(lon, lat)
+
+    def _build_kernel(self, cutoff):
+        # Gaussian kernel sampled on the lattice offsets, truncated at cutoff standard deviations
+        inv_cov = np.linalg.inv(self.covariance)
+        norm = np.sqrt(np.linalg.det(2 * np.pi * self.covariance))
+        self.kx = int(min(np.ceil(cutoff * np.sqrt(self.covariance[0, 0])/self.dx), self.nx))
+        self.ky = int(min(np.ceil(cutoff * np.sqrt(self.covariance[1, 1])/self.dy), self.ny))
+        u, v = np.meshgrid(np.arange(-self.kx, self.kx + 1) * self.dx, np.arange(-self.ky, self.ky + 1) * self.dy)
+        energy = inv_cov[0, 0] * u**2 + 2 * inv_cov[0, 1] * u * v + inv_cov[1, 1] * v**2
+        return np.exp(-0.5 * energy)/norm
+
+    def _linear_bins(self, lon, lat):
+        # Linear binning: each particle is split between its 2x2 surrounding lattice points.
+        # Returned rows/cols are shifted by one so particles half a cell outside the lattice are kept
+        fx = (np.asarray(lon) - self.x0)/self.dx
+        fy = (np.asarray(lat) - self.y0)/self.dy
+        ix = np.floor(fx).astype('int')
+        iy = np.floor(fy).astype('int')
+        tx = fx - ix
+        ty = fy - iy
+
+        rows = np.concatenate([iy, iy, iy + 1, iy + 1]) + 1
+        cols = np.concatenate([ix, ix + 1, ix, ix + 1]) + 1
+        weights = np.concatenate([(1 - ty) * (1 - tx), (1 - ty) * tx, ty * (1 - tx), ty * tx])
+
+        valid = (rows >= 0) & (rows < self.ny + 2) & (cols >= 0) & (cols < self.nx + 2)
+        return rows[valid], cols[valid], weights[valid]
+
+    def add(self, lon, lat, sign=1.0):
+        if len(lon) == 0:
+            return
+        rows, cols, weights = self._linear_bins(lon, lat)
+
+        # Only the window of the padded lattice touched by these particles is convolved
+        r0, r1 = np.min(rows), np.max(rows) + 1
+        c0, c1 = np.min(cols), np.max(cols) + 1
+        hist = np.zeros((r1 - r0, c1 - c0))
+        np.add.at(hist, (rows - r0, cols - c0), weights)
+        contribution = fftconvolve(hist, self.kernel, mode='full')
+
+        # Window row r of the padded lattice plus kernel offset lands on lattice row r - 1 + offset
+        top = r0 - 1 - self.ky
+        left = c0 - 1 - self.kx
+        dr0, dc0 = max(0, -top), max(0, -left)
+        dr1 = min(contribution.shape[0], self.ny - top)
+        dc1 = min(contribution.shape[1], self.nx - left)
+        if dr1 <= dr0 or dc1 <= dc0:
+            return
+        self.density[top + dr0:top + dr1, left + dc0:left + dc1] += sign * contribution[dr0:dr1, dc0:dc1]
+
+    def remove(self, lon, lat):
+        # Subtracting the kernels of removed particles, only their neighborhood is touched
+        self.add(lon, lat, sign=-1.0)
+        self.n -= len(lon)
+
+    def evaluate(self):
+        # Density at every lattice point, indexed [y, x] (same as gaussian_kde.evaluate)
+        if self.n <= 0:
+            return np.zeros((self.ny, self.nx))
+        return np.maximum(self.density, 0)/self.n
@@ -1,28 +1,44 @@
+import uuid
+
 from scipy.stats import gaussian_kde
 
 import numpy as np
 from fastkml import kml
-from shapely import geometry
-import shapefile
+
+from grid_maps import rasterize_region, CoastDistance, BinnedKDE, bin_index
+from grid_cache import GridCache, file_signature
+from geodata_cache import load_coastline
+from particle_store import ParticleIndex
+from transport import GridEncoder
 
 KDE_BW = 0.2        # KDE Bandwidth
+KDE_MODE = 'exact'  # KDE computation: 'exact' (scipy gaussian_kde), 'binned' (particles binned on grid, FFT convolution)
+                    # or 'incremental' (binned, robot feedback only subtracts consumed particles until next gnome step)
 RES_GRID = 111.0    # Grid resolution (km in each cell)
+COAST_DIST_MODE = 'vertex' # Distance to coast: 'vertex' (nearest coast point) or 'segment' (nearest coast line)
+COAST_SHP = './assets/shp/BR_UF_2020.shp'
+GRID_RANGE = (-1, 5)    # Grids values: -1 on No Fly Zones cells, [0, 5] inside the region
+DIST_GRID_SCALE = 100   # Distance to coast sensibility is scaled to [-100, 500]
 
 class Mission(object):
-    def __init__(self, t_mission, robots, region, simulation, env_sensitivity_mode):
+    def __init__(self, t_mission, robots, region, simulation, env_sensitivity_mode, kde_mode=KDE_MODE):
         self.simulation = simulation
+        self.kde_mode = kde_mode
         self.res_grid = RES_GRID
         self.robots = robots
         self.env_sensitvity_mode = env_sensitivity_mode
+        self._forecast_kde = {}     # horizon -> (forecast version, valid time, kde)
 
-        # Read shape file
-        #shpfile = shapefile.Reader('./assets/shp/BRA_admin_AL.shp')
-        shpfile = shapefile.Reader('./assets/shp/BR_UF_2020.shp')
-        feature = shpfile.shapeRecords()[0]
-        first = feature.shape.__geo_interface__
-        shp = geometry.shape(first)
-        #al_coords = np.array(shp.geoms[3].exterior.coords)
-        al_coords = np.array(shp.exterior.coords)
+        # Mission static grids and region are identified by uid, robots positions by their version
+        self.uid = uuid.uuid4().hex[:12]
+        self.robots_version = 0
+
+        # Grids responses, encoded once per grid version
+        self._kde_encoder = GridEncoder('kde', *GRID_RANGE)
+        if env_sensitivity_mode == 0:
+            self._env_encoder = GridEncoder('env_sensibility', *GRID_RANGE)
+        else:
+            self._env_encoder = GridEncoder('env_sensibility', *[DIST_GRID_SCALE * r for r in GRID_RANGE])
 
         # Read kml and extract coordinates
         with open(region, 'rb') as regionFile:
@@ -47,61 +63,22 @@ class Mission(object):
         self.width = int(np.ceil(RES_GRID * (self.maxLon - self.minLon)))
         self.height = int(np.ceil(RES_GRID * (self.maxLat - self.minLat)))
         
-        self.mask = np.zeros((self.height, self.width))
-        self.dist_grid = np.zeros((self.height, self.width))
-
-        # Checking which cells are inside the region of interest polygon and calculating distance to nearest point in coast
-        for i in range(self.width):
-            for j in range(self.height):
-                point_lon = (i/RES_GRID) + self.minLon
-                point_lat = (j/RES_GRID) + self.minLat
-                # Checking if point is outside permitted fly zone
-                # print(str(point_lon) + ', ' + str(point_lat) + ' -> ' + str(regionPolygon.intersects(geometry.Point(point_lon, point_lat))))
-                fly_zone_flag = True
-                if regionPolygon.intersects(geometry.Point(point_lon, point_lat)) == False:
-                    fly_zone_flag = False
-                else:
-                    for k in range(len(innerPoly)):
-                        if innerPoly[k].intersects(geometry.Point(point_lon, point_lat)) == True:
-                            fly_zone_flag = False
-                            break
-
-                if fly_zone_flag == True:
-                    dist = np.sqrt((point_lon - al_coords[:, 0])**2 + (point_lat - al_coords[:, 1])**2)
-                    self.dist_grid[j, i] = RES_GRID * np.min(dist)
-                else:
-                    self.mask[j, i] = 1
-      
-        self.mask_idx = np.argwhere(self.mask.T == 0) # indexes of cells inside polygon
-
-        # Normalizing Environmental Sensibility and applying region of interest mask
-        max_dist = np.max(self.dist_grid)
-        self.dist_grid = 1/max_dist * 5 * ((1 - self.mask) * max_dist - self.dist_grid) - self.mask
-        self.dist_grid *= 100
-        
-        # Filtering particles to square domain and saving its indexes for later use
-        I1 = np.where(self.simulation.lon >= self.minLon)[0]
-        lonI = simulation.lon[I1]
-        latI = simulation.lat[I1]
-
-        I2 = np.where(lonI <= self.maxLon)[0]
-        lonI = lonI[I2]
-        latI = latI[I2]
-
-        I3 = np.where(latI >= self.minLat)[0]
-        lonI = lonI[I3]
-        latI = latI[I3]
-
-        I4 = np.where(latI <= self.maxLat)[0]
-        lonI = lonI[I4]
-        latI = latI[I4]
-
-        self.idx = I1[I2[I3[I4]]]
-
-        # Computing kde with filtered particles
-        self.kde = self._compute_kde(lonI, latI)
+        # Grid maps only depend on the region, grid resolution and static datasets, reusing them when cached
+        cache = GridCache()
+        key = cache.key(self.coords, self.innerPolyCoords, RES_GRID, COAST_DIST_MODE, file_signature(COAST_SHP), \
+            simulation.isl_field.isl, simulation.isl_field.sigma, simulation.isl_field.radius)
+        grids = cache.load(key)
+        if grids is not None:
+            self.mask = grids['mask']
+            self.mask_idx = np.argwhere(self.mask.T == 0) # indexes of cells inside polygon
+            self.dist_grid = grids['dist_grid']
+            self.potential_field = grids['potential_field']
+        else:
+            self._compute_grid_maps(regionPolygon, innerPoly)
+            cache.store(key, {'mask': self.mask, 'dist_grid': self.dist_grid, 'potential_field': self.potential_field})
 
-        self.potential_field = self._compute_isl_pot_field(simulation.isl)
+        # KDE is computed with particles inside the region once the mission is set on the simulation
+        self.kde = -self.mask
 
         # Initializing robots positions in grid map
         found_flag = False
@@ -126,7 +103,62 @@ class Mission(object):
             robot['pos_x'] = start_pos_x
             robot['pos_y'] = start_pos_y
 
-    def _compute_kde(self, lon, lat):
+    def _compute_grid_maps(self, regionPolygon, innerPoly):
+        # Checking which cells are inside the region of interest polygon
+        self.mask, self.mask_idx = rasterize_region(regionPolygon, innerPoly, self.minLon, self.minLat, self.width, self.height, RES_GRID)
+
+        # Read shape file (preprocessed coordinates are cached)
+        #al_coords = load_coastline('./assets/shp/BRA_admin_AL.shp')
+        al_coords = load_coastline(COAST_SHP)
+
+        # Calculating distance to nearest point in coast for cells inside the region
+        coast = CoastDistance(al_coords)
+        self.dist_grid = np.zeros((self.height, self.width))
+        points_lon = (self.mask_idx[:, 0]/RES_GRID) + self.minLon
+        points_lat = (self.mask_idx[:, 1]/RES_GRID) + self.minLat
+        self.dist_grid[self.mask_idx[:, 1], self.mask_idx[:, 0]] = RES_GRID * coast.query(points_lon, points_lat, COAST_DIST_MODE)
+
+        # Normalizing Environmental Sensibility and applying region of interest mask
+        max_dist = np.max(self.dist_grid)
+        self.dist_grid = 1/max_dist * 5 * ((1 - self.mask) * max_dist - self.dist_grid) - self.mask
+        self.dist_grid *= DIST_GRID_SCALE
+
+        self.potential_field = self._compute_isl_pot_field(self.simulation.isl_field)
+
+    def _update_kde(self):
+        particles = self.simulation.particles
+        self._apply_kde(particles, self._prepare_kde(particles))
+
+    def _prepare_kde(self, particles):
+        # Filtering particles to square domain and computing their KDE, no mission state is changed
+        idx = particles.bbox(self.minLon, self.maxLon, self.minLat, self.maxLat)
+        lonI, latI = particles.get(idx)
+        return idx, self._kde_grid(lonI, latI)
+
+    def _apply_kde(self, particles, prepared):
+        # Grouping particles by grid cell for later consumption
+        idx, (kde, binX, binY, h, density) = prepared
+        self.kde = kde
+        self.binX = binX
+        self.binY = binY
+        self._h = h
+        self._density = density
+
+        particles.bind_cells(idx, binX, binY, self.width, self.height)
+
+    def _apply_consumption(self, consumed):
+        # Updating KDE after particles of cells were consumed, consumed is a list of (xgrid, ygrid, lon, lat)
+        consumed = [c for c in consumed if len(c[2]) > 0]
+        if len(consumed) == 0:
+            return
+
+        if self.kde_mode == 'incremental':
+            for xgrid, ygrid, lon_c, lat_c in consumed:
+                self.kde = self._remove_from_kde(lon_c, lat_c, xgrid, ygrid)
+        else:
+            self._update_kde()
+
+    def _kde_grid(self, lon, lat):
         print('Computing new KDE')
         kde = -1 * self.mask # No Fly Zones cells are -1 valued
     
@@ -140,53 +172,42 @@ class Mission(object):
 
         binX, binY = self._get_bins(lon, lat, xEdges, yEdges)
 
-        lonp = np.array([], dtype='float64')
-        latp = np.array([], dtype='float64')
-
         # Find which particles are inside the polygon
-        for i in range(self.mask_idx.shape[0]):
-            idxs = np.where(np.logical_and(binX == self.mask_idx[i, 0], binY == self.mask_idx[i, 1]))[0]
-            lonp = np.append(lonp, lon[idxs])
-            latp = np.append(latp, lat[idxs])
+        inside = self.mask[binY, binX] == 0
+        lonp = lon[inside]
+        latp = lat[inside]
 
+        density = None
         if len(lonp) != 0:
-            f = gaussian_kde(np.vstack([lonp, latp]), bw_method=KDE_BW)
-            f_values = f.evaluate(positions).reshape(kde.shape)
+            if self.kde_mode == 'binned' or self.kde_mode == 'incremental':
+                density = BinnedKDE(xls, yls, lonp, latp, KDE_BW)
+                f_values = density.evaluate()
+            else:
+                f = gaussian_kde(np.vstack([lonp, latp]), bw_method=KDE_BW)
+                f_values = f.evaluate(positions).reshape(kde.shape)
             kde = 5/np.max(f_values) * (1 - self.mask) * f_values * (h>0) + kde
         else:
             kde = -self.mask
         print('Computed new KDE')
 
-        self.binX = binX
-        self.binY = binY
+        return kde, binX, binY, h, density
 
-        return kde
+    def _remove_from_kde(self, lon, lat, xgrid, ygrid):
+        # Subtracting consumed particles (all in cell xgrid, ygrid) from the binned density,
+        # bandwidth and bins are kept until the next full computation
+        self._h[ygrid, xgrid] -= len(lon)
+        if self.mask[ygrid, xgrid] == 0 and self._density is not None:
+            self._density.remove(lon, lat)
 
-    def _compute_isl_pot_field(self, isl):
-        # Filtering ISL
-        idx = np.where(isl[:, 1] >= self.minLat - 1)[0]
-        isl_filtered = isl[idx, :]
+        if self._density is None or self._density.n == 0:
+            return -self.mask
 
-        idx = np.where(isl_filtered[:, 1] <= self.maxLat + 1)[0]
-        isl_filtered = isl_filtered[idx, :]
+        f_values = self._density.evaluate()
+        return 5/np.max(f_values) * (1 - self.mask) * f_values * (self._h>0) - self.mask
 
+    def _compute_isl_pot_field(self, isl_field):
         # Gaussians ISL-centered as potential fields
-        sigma = 0.1
-        potential_field = np.zeros((self.height, self.width))
-        for potential in isl_filtered:
-            for i in range(self.width):
-                for j in range(self.height):
-                    curr_lon = (i/RES_GRID) + self.minLon
-                    curr_lat = (j/RES_GRID) + self.minLat
-
-                    lon_0 = potential[0]
-                    lat_0 = potential[1]
-                    Amp = potential[2]
-
-                    potential_field[j, i] += Amp * np.exp(-( \
-                        ((curr_lon - lon_0)**2)/(2 * sigma**2) + \
-                            ((curr_lat - lat_0)**2)/(2 * sigma**2) \
-                                ))
+        potential_field = isl_field.compute(self.minLon, self.minLat, self.width, self.height, RES_GRID)
         
         max_potential = np.max(potential_field)
         potential_field = 1/max_potential * 5 * (1 - self.mask) * potential_field - self.mask
@@ -194,20 +215,8 @@ class Mission(object):
         return potential_field
 
     def _get_bins(self, lon, lat, xEdges, yEdges):
-        binX = np.zeros(len(lon), dtype='int')
-        binY = np.zeros(len(lat), dtype='int')
-
-        for i in range(len(lon)):
-            for j in range(len(xEdges)-1):
-                if (lon[i] >= xEdges[j]) and (lon[i] <= xEdges[j+1]):
-                    binX[i] = j
-                    break
-
-        for i in range(len(lat)):
-            for j in range(len(yEdges)-1):
-                if (lat[i] >= yEdges[j]) and (lat[i] <= yEdges[j+1]):
-                    binY[i] = j
-                    break
+        binX = bin_index(lon, xEdges)
+        binY = bin_index(lat, yEdges)
 
         return binX, binY
     
@@ -221,39 +230,41 @@ class Mission(object):
             robot['pos_x'] = xgrid
             robot['pos_y'] = ygrid
             robot['heading'] = robot_heading
+            self.robots_version += 1
         except StopIteration:
             print('[ROBOT_FB] No robot with id ' + robot_id)
             return
+        self.simulation.events.publish('robots', {'version': self.robots_version})
         
-        # Consume existing particles
-        particles_idx = self.idx[np.where(np.logical_and(self.binX == xgrid, self.binY == ygrid))[0]]
-        self.simulation.lon = np.delete(self.simulation.lon, particles_idx)
-        self.simulation.lat = np.delete(self.simulation.lat, particles_idx)
-
-        # Compute new global idx
-        I1 = np.where(self.simulation.lon >= self.minLon)[0]
-        lonI = self.simulation.lon[I1]
-        latI = self.simulation.lat[I1]
-
-        I2 = np.where(lonI <= self.maxLon)[0]
-        lonI = lonI[I2]
-        latI = latI[I2]
-
-        I3 = np.where(latI >= self.minLat)[0]
-        lonI = lonI[I3]
-        latI = latI[I3]
-
-        I4 = np.where(latI <= self.maxLat)[0]
-        lonI = lonI[I4]
-        latI = latI[I4]
-
-        self.idx = I1[I2[I3[I4]]]
-
-        # Compute kde
-        self.kde = self._compute_kde(lonI, latI)
+        # Consume existing particles, the kde is updated by the simulation in order with other changes
+        self.simulation.consume_cells([(xgrid, ygrid)])
 
     def get_kde(self):
-        return self.kde
+        return self.get_versioned_kde()[1]
+
+    def get_versioned_kde(self):
+        # KDE published with the latest particles and its snapshot version, if this mission was already set on the simulation
+        snapshot = self.simulation.snapshot
+        if snapshot.mission is self:
+            return snapshot.version, snapshot.kde
+        return 0, self.kde
+
+    def get_kde_encoded(self, format_name, compress):
+        # Encoded KDE (see transport) and its snapshot version
+        version, kde = self.get_versioned_kde()
+        return self._kde_encoder.get(version, kde, format_name, compress), version
+
+    def get_kde_forecast(self, forecast):
+        # KDE of each forecast horizon particles, computed once per forecast run
+        kde_forecast = {}
+        for horizon, (version, valid_time, lon, lat) in forecast.items():
+            cached = self._forecast_kde.get(horizon)
+            if cached is None or cached[0] != version:
+                inside = ParticleIndex(lon, lat).query(self.minLon, self.maxLon, self.minLat, self.maxLat)
+                cached = (version, valid_time, self._kde_grid(lon[inside], lat[inside])[0])
+                self._forecast_kde[horizon] = cached
+            kde_forecast[horizon] = (cached[1], cached[2])
+        return kde_forecast
     
     def get_robots_pos(self):
         robots_pos = np.array([[robot['pos_x'], robot['pos_y']] for robot in self.robots])
@@ -282,4 +293,8 @@ class Mission(object):
         if self.env_sensitvity_mode == 0:
             return self.potential_field
         else:
-            return self.dist_grid
\ No newline at end of file
+            return self.dist_grid
+
+    def get_env_sensibility_encoded(self, format_name, compress):
+        # The sensibility grid does not change during the mission
+        return self._env_encoder.get(0, self.get_env_sensibility(), format_name, compress)
@@ -0,0 +1,129 @@
+import os
+import queue
+import threading
+
+import numpy as np
+
+from atomic_file import atomic_write
+
+HISTORY_DIR = './assets/history'
+HISTORY_RETENTION = 24 * 60 * 60            # History window kept (seconds)
+SEGMENT_MAX_BYTES = 64 * 1024 * 1024        # Size of a segment file before starting a new one
+
+# One particle record in a segment file
+RECORD = np.dtype([('lon', '<f4'), ('lat', '<f4'), ('status', 'u1')])
+# One step entry in the index file: step time (unix seconds), segment number, first record and records count
+INDEX_ENTRY = np.dtype([('time', '<f8'), ('segment', '<i8'), ('offset', '<i8'), ('count', '<i8')])
+
+class ParticleHistory(object):
+    def __init__(self, history_dir=HISTORY_DIR, retention=HISTORY_RETENTION, segment_max_bytes=SEGMENT_MAX_BYTES):
+        self.history_dir = history_dir
+        self.retention = retention
+        self.segment_max_bytes = segment_max_bytes
+        os.makedirs(history_dir, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._index_file = os.path.join(history_dir, 'index.bin')
+        if os.path.exists(self._index_file):
+            # Whole entries only, the process may have died while appending one
+            with open(self._index_file, 'rb') as indexFile:
+                data = indexFile.read()
+            self._index = np.frombuffer(data, dtype=INDEX_ENTRY, count=len(data) // INDEX_ENTRY.itemsize).copy()
+            if len(data) > self._index.nbytes:
+                os.truncate(self._index_file, self._index.nbytes)
+        else:
+            self._index = np.zeros(0, dtype=INDEX_ENTRY)
+
+        # Appending to the last segment, unless it is full
+        if len(self._index) > 0:
+            self._segment = int(self._index['segment'][-1])
+            self._segment_records = int(self._index['offset'][-1] + self._index['count'][-1])
+        else:
+            self._segment = 0
+            self._segment_records = 0
+        self._discard_unindexed()
+
+        # Snapshots are written by a background thread, the step loop only queues them
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._writer, daemon=True)
+        self._thread.start()
+
+    def _segment_file(self, segment):
+        return os.path.join(self.history_dir, 'segment_%06i.bin' % segment)
+
+    def _discard_unindexed(self):
+        # Records written after the last indexed step (the process died before indexing them) are dropped,
+        # so new steps are appended right after the indexed ones
+        segment_file = self._segment_file(self._segment)
+        if os.path.exists(segment_file) and os.path.getsize(segment_file) > self._segment_records * RECORD.itemsize:
+            os.truncate(segment_file, self._segment_records * RECORD.itemsize)
+        for filename in os.listdir(self.history_dir):
+            if filename.startswith('segment_') and int(filename[8:14]) > self._segment:
+                os.remove(os.path.join(self.history_dir, filename))
+
+    def append(self, step_time, lon, lat, status=None):
+        records = np.empty(len(lon), dtype=RECORD)
+        records['lon'] = lon
+        records['lat'] = lat
+        records['status'] = 2 if status is None else status # 2: in_water
+        self._queue.put((step_time, records))
+
+    def _writer(self):
+        while True:
+            step_time, records = self._queue.get()
+            try:
+                self._write(step_time, records)
+            except OSError as error:
+                print('[HISTORY] Could not save step: ' + str(error))
+
+    def _write(self, step_time, records):
+        if self._segment_records > 0 and (self._segment_records + len(records)) * RECORD.itemsize > self.segment_max_bytes:
+            self._segment += 1
+            self._segment_records = 0
+
+        with open(self._segment_file(self._segment), 'ab') as segmentFile:
+            segmentFile.write(records.tobytes())
+
+        entry = np.array([(step_time, self._segment, self._segment_records, len(records))], dtype=INDEX_ENTRY)
+        self._segment_records += len(records)
+
+        with self._lock:
+            self._index = np.concatenate([self._index, entry])
+            with open(self._index_file, 'ab') as indexFile:
+                indexFile.write(entry.tobytes())
+            self._expire(step_time)
+
+    def _expire(self, now):
+        expired = self._index['time'] < now - self.retention
+        if not np.any(expired):
+            return
+        self._index = self._index[np.logical_not(expired)]
+
+        with atomic_write(self._index_file) as tmp:
+            self._index.tofile(tmp)
+
+        # Removing segments with no steps left, except the one being written
+        for filename in os.listdir(self.history_dir):
+            if filename.startswith('segment_'):
+                segment = int(filename[8:14])
+                if segment != self._segment and segment not in self._index['segment']:
+                    os.remove(os.path.join(self.history_dir, filename))
+
+    def steps(self):
+        # Times (unix seconds) of the steps available
+        with self._lock:
+            return self._index['time'].copy()
+
+    def get(self, t):
+        # Latest step at or before t: its time and records (memory mapped, no copy), None if there is none
+        with self._lock:
+            candidates = np.where(self._index['time'] <= t)[0]
+            if len(candidates) == 0:
+                return None, None
+            entry = self._index[candidates[-1]]
+
+        if entry['count'] == 0:
+            return entry['time'], np.zeros(0, dtype=RECORD)
+        records = np.memmap(self._segment_file(int(entry['segment'])), dtype=RECORD, mode='r', \
+            offset=int(entry['offset']) * RECORD.itemsize, shape=(int(entry['count']),))
+        return entry['time'], records
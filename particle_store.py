@@ -0,0 +1,205 @@
+import numpy as np
+
+COMPACT_THRESHOLD = 0.25    # Dead particles fraction that triggers compaction
+INDEX_CELL_SIZE = 0.02      # Spatial index cell size (degrees)
+
+class ParticleIndex(object):
+    def __init__(self, lon, lat, member=None, cell_size=INDEX_CELL_SIZE):
+        lon = np.asarray(lon)
+        lat = np.asarray(lat)
+        self.lon = lon
+        self.lat = lat
+        self.member = None if member is None else np.asarray(member)     # Ensemble member of each particle
+        self.n = len(lon)
+        if self.n == 0:
+            self.nx = self.ny = 0
+            return
+
+        self.min_lon = np.min(lon)
+        self.min_lat = np.min(lat)
+
+        # Growing cells if needed so the grid has at most a few cells per particle
+        span_lon = np.max(lon) - self.min_lon
+        span_lat = np.max(lat) - self.min_lat
+        while (np.floor(span_lon/cell_size) + 1) * (np.floor(span_lat/cell_size) + 1) > 4 * self.n + 16:
+            cell_size *= 2
+        self.cell_size = cell_size
+        self.nx = int(np.floor(span_lon/cell_size)) + 1
+        self.ny = int(np.floor(span_lat/cell_size)) + 1
+
+        # Particles sorted by cell, particles of cell c = cy * nx + cx are self._sorted[self._offsets[c]:self._offsets[c + 1]]
+        cx = np.minimum(((lon - self.min_lon)/cell_size).astype('int'), self.nx - 1)
+        cy = np.minimum(((lat - self.min_lat)/cell_size).astype('int'), self.ny - 1)
+        cell = cy * self.nx + cx
+        self._sorted = np.argsort(cell, kind='stable')
+        self._offsets = np.concatenate([[0], np.cumsum(np.bincount(cell, minlength=self.nx * self.ny))])
+
+    def query(self, minLon, maxLon, minLat, maxLat):
+        # Indexes (ascending) of particles inside the bounding box
+        if self.n == 0 or maxLon < minLon or maxLat < minLat:
+            return np.array([], dtype='int')
+
+        cx0 = max(int(np.floor((minLon - self.min_lon)/self.cell_size)), 0)
+        cx1 = min(int(np.floor((maxLon - self.min_lon)/self.cell_size)), self.nx - 1)
+        cy0 = max(int(np.floor((minLat - self.min_lat)/self.cell_size)), 0)
+        cy1 = min(int(np.floor((maxLat - self.min_lat)/self.cell_size)), self.ny - 1)
+        if cx1 < cx0 or cy1 < cy0:
+            return np.array([], dtype='int')
+
+        # Cells cx0..cx1 of a row are contiguous in the sorted order
+        candidates = np.concatenate([self._sorted[self._offsets[cy * self.nx + cx0]:self._offsets[cy * self.nx + cx1 + 1]] for cy in range(cy0, cy1 + 1)])
+
+        # Only particles in border cells may fall outside the box
+        lon = self.lon[candidates]
+        lat = self.lat[candidates]
+        inside = (lon >= minLon) & (lon <= maxLon) & (lat >= minLat) & (lat <= maxLat)
+        return np.sort(candidates[inside])
+
+class ParticleStore(object):
+    def __init__(self, lon, lat, member=None, compact_threshold=COMPACT_THRESHOLD):
+        self._lon = np.asarray(lon, dtype='float64')
+        self._lat = np.asarray(lat, dtype='float64')
+        # Ensemble member of each particle (0: control run)
+        self._member = np.zeros(len(self._lon), dtype='uint16') if member is None else np.asarray(member, dtype='uint16')
+        self._alive = np.ones(len(self._lon), dtype='bool')
+        self._n_dead = 0
+        self.compact_threshold = compact_threshold
+
+        # Alive particles arrays, rebuilt only after changes
+        self._alive_lon = None
+        self._alive_lat = None
+        self._alive_member = None
+
+        # Spatial index, built on first query
+        self._index = None
+
+        # Particles grouped by grid cell (CSR): particles of cell c = y * width + x
+        # are self._cell_particles[self._offsets[c]:self._offsets[c + 1]]
+        self._width = 0
+        self._height = 0
+        self._offsets = np.zeros(1, dtype='int')
+        self._cell_particles = np.array([], dtype='int')
+
+    def __len__(self):
+        return len(self._lon) - self._n_dead
+
+    @property
+    def lon(self):
+        self._update_alive()
+        return self._alive_lon
+
+    @property
+    def lat(self):
+        self._update_alive()
+        return self._alive_lat
+
+    @property
+    def member(self):
+        self._update_alive()
+        return self._alive_member
+
+    def _update_alive(self):
+        if self._alive_lon is None:
+            if self._n_dead == 0:
+                self._alive_lon = self._lon
+                self._alive_lat = self._lat
+                self._alive_member = self._member
+            else:
+                self._alive_lon = self._lon[self._alive]
+                self._alive_lat = self._lat[self._alive]
+                self._alive_member = self._member[self._alive]
+
+    def spatial_index(self):
+        # Index over all particles of the step (dead ones included), built once until compaction
+        if self._index is None:
+            self._index = ParticleIndex(self._lon, self._lat, self._member)
+        return self._index
+
+    def alive_mask(self):
+        # Copy of the alive flags over the spatial index particles
+        return self._alive.copy()
+
+    def bbox(self, minLon, maxLon, minLat, maxLat):
+        # Store indexes of alive particles inside the bounding box
+        idx = self.spatial_index().query(minLon, maxLon, minLat, maxLat)
+        return idx[self._alive[idx]]
+
+    def get(self, idx):
+        return self._lon[idx], self._lat[idx]
+
+    def alive_positions(self, idx):
+        # Positions of alive particles idx in the lon/lat arrays
+        if self._n_dead == 0:
+            return np.asarray(idx)
+        return (np.cumsum(self._alive) - 1)[idx]
+
+    def bind_cells(self, idx, binX, binY, width, height):
+        # Grouping particles idx by their grid cell (binX, binY)
+        cell = np.asarray(binY) * width + np.asarray(binX)
+        order = np.argsort(cell, kind='stable')
+        self._width = width
+        self._height = height
+        self._cell_particles = np.asarray(idx)[order]
+        self._offsets = np.concatenate([[0], np.cumsum(np.bincount(cell, minlength=width * height))])
+
+    def _cell_slice(self, x, y):
+        if x < 0 or x >= self._width or y < 0 or y >= self._height:
+            return np.array([], dtype='int')
+        c = y * self._width + x
+        return self._cell_particles[self._offsets[c]:self._offsets[c + 1]]
+
+    def cell_particles(self, x, y):
+        # Store indexes of alive particles in cell (x, y)
+        idx = self._cell_slice(x, y)
+        return idx[self._alive[idx]]
+
+    def bound_cells(self):
+        # Alive particles bound to grid cells: their positions in the lon/lat arrays and cells x, y
+        cells = np.repeat(np.arange(len(self._offsets) - 1), np.diff(self._offsets))
+        alive = self._alive[self._cell_particles]
+        idx = self._cell_particles[alive]
+        cells = cells[alive]
+        order = np.argsort(idx)
+        idx = idx[order]
+        cells = cells[order]
+        if self._width == 0:
+            return idx, cells, cells
+        return self.alive_positions(idx), cells % self._width, cells // self._width
+
+    def consume_cell(self, x, y):
+        # Marking particles in cell (x, y) as dead, returns their lon/lat
+        idx = self.cell_particles(x, y)
+        lon = self._lon[idx]
+        lat = self._lat[idx]
+        if len(idx) > 0:
+            self._alive[idx] = False
+            self._n_dead += len(idx)
+            self._alive_lon = None
+            self._alive_lat = None
+            self._alive_member = None
+            if self._n_dead > self.compact_threshold * len(self._lon):
+                self.compact()
+        return lon, lat
+
+    def compact(self):
+        if self._n_dead == 0:
+            return
+
+        # New index of each kept particle
+        new_idx = np.cumsum(self._alive) - 1
+
+        # Dropping dead particles from the cell groups, keeping cell order
+        cells = np.repeat(np.arange(len(self._offsets) - 1), np.diff(self._offsets))
+        kept = self._alive[self._cell_particles]
+        self._cell_particles = new_idx[self._cell_particles[kept]]
+        self._offsets = np.concatenate([[0], np.cumsum(np.bincount(cells[kept], minlength=len(self._offsets) - 1))])
+
+        self._lon = self._lon[self._alive]
+        self._lat = self._lat[self._alive]
+        self._member = self._member[self._alive]
+        self._alive = np.ones(len(self._lon), dtype='bool')
+        self._n_dead = 0
+        self._alive_lon = None
+        self._alive_lat = None
+        self._alive_member = None
+        self._index = None
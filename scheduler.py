@@ -0,0 +1,96 @@
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+OVERRUN_POLICY = 'skip'     # Cycles due while a run overran: 'skip' (wait for the next slot), 'catch_up' (run each of them
+                            # back to back) or 'coalesce' (run once right away for all of them)
+STATS_SIZE = 100            # Cycles kept for lateness/duration statistics
+
+class Scheduler(object):
+    # Runs task at a fixed cadence: cycle k is due at start epoch + k * interval, whatever the task duration
+    def __init__(self, name, interval, task, policy=OVERRUN_POLICY, stats_size=STATS_SIZE):
+        if policy not in ('skip', 'catch_up', 'coalesce'):
+            raise ValueError('Unknown overrun policy: ' + str(policy))
+
+        self.name = name
+        self.interval = interval
+        self.task = task
+        self.policy = policy
+
+        self._thread = None
+        self._stop = threading.Event()
+        self.epoch = None
+
+        # Per cycle (due time, lateness, duration), lateness is how late the run started after its due time
+        self._cycles = deque(maxlen=stats_size)
+        self.n_cycles = 0
+        self.n_skipped = 0
+        self.n_overruns = 0
+
+    @property
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, epoch=None):
+        # First cycle is due one interval after the epoch (now by default)
+        if self.is_running:
+            return
+        self._stop.clear()
+        self.epoch = time.monotonic() if epoch is None else epoch
+        self._thread = threading.Thread(target=self._loop, name=self.name, daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        # No new cycle is started, a running one is waited for (up to timeout)
+        self._stop.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout)
+
+    def _loop(self):
+        k = 1
+        while True:
+            due = self.epoch + k * self.interval
+            if self._stop.wait(max(due - time.monotonic(), 0)):
+                break
+
+            started = time.monotonic()
+            try:
+                self.task()
+            except Exception as error:
+                print('[' + self.name.upper() + '] Cycle failed: ' + str(error))
+            finished = time.monotonic()
+
+            self._cycles.append((due - self.epoch, started - due, finished - started))
+            self.n_cycles += 1
+            if finished - started > self.interval:
+                self.n_overruns += 1
+
+            # Latest cycle already due
+            latest = int(np.floor((finished - self.epoch)/self.interval))
+            missed = max(latest - k, 0)
+            if self.policy == 'catch_up' or missed == 0:
+                k += 1
+            elif self.policy == 'coalesce':
+                self.n_skipped += missed - 1
+                k = latest
+            else:
+                self.n_skipped += missed
+                k = latest + 1
+
+    def stats(self):
+        cycles = np.array(self._cycles).reshape((-1, 3))
+        stats = {
+            'name': self.name,
+            'interval': self.interval,
+            'policy': self.policy,
+            'running': self.is_running,
+            'cycles': self.n_cycles,
+            'skipped': self.n_skipped,
+            'overruns': self.n_overruns
+        }
+        if len(cycles) > 0:
+            stats['lateness'] = {'last': float(cycles[-1, 1]), 'mean': float(np.mean(cycles[:, 1])), 'max': float(np.max(cycles[:, 1]))}
+            stats['duration'] = {'last': float(cycles[-1, 2]), 'mean': float(np.mean(cycles[:, 2])), 'max': float(np.max(cycles[:, 2]))}
+        return stats
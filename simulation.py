@@ -1,20 +1,38 @@
-from threading import Timer
+import os
+import uuid
+import calendar
+from threading import Lock
 from gnome_interface import GnomeInterface
 from datetime import datetime, timedelta
 
 import numpy as np
 from fastkml import kml
 from shapely import geometry
-import shapefile
+
+from grid_maps import IslPotentialField
+from particle_store import ParticleStore
+from geodata_cache import load_isl
+from frame_renderer import FrameRenderer
+from particle_history import ParticleHistory
+from forecast import Forecaster
+from ensemble import Ensemble
+from snapshot import Snapshot
+from scheduler import Scheduler
+from transport import ParticlesEncoder
+from tiles import TileCache, LAYERS, MAX_ZOOM
+from events import EventBus
+
+ISL_SHP = './assets/shp/ISL.shp'
 
 class Simulation(object):
     def __init__(self, interval, north, south, east, west):
 
-        self._timer     = None
         self.interval   = interval
-        self.is_running = False
         self.mission    = None
 
+        # Steps run at a fixed cadence, a long step does not shift the following ones
+        self._scheduler = Scheduler('simulation', interval, self._run)
+
         self.north = north
         self.south = south
         self.east = east
@@ -23,105 +41,212 @@ class Simulation(object):
         # Instance for gnome interface
         self._gnome = GnomeInterface(north, south, east, west)
 
-        # Read ISL shape file
-        isl_shp = shapefile.Reader('./assets/shp/ISL.shp', encoding="ISO8859-1")
-        isl_attr = np.array(isl_shp.records())[:, 0] # Gets only isl value
-        isl_features = isl_shp.shapeRecords()
-        self.isl = np.zeros((len(isl_attr) - len(np.where(isl_attr == 0)[0]), 3)) # [lon, lat, isl_value]
-        cnt = 0
-        for i in range(len(isl_features)):
-            # Each feature has a geo_interface with a list of coordinates representing an ISL value
-            if (isl_attr[i] > 0):
-                if (isl_features[i].shape.__geo_interface__['type'] == 'LineString'):
-                    mean_lon, mean_lat = np.mean(np.array(isl_features[i].shape.__geo_interface__['coordinates']), axis = 0)
-                elif (isl_features[i].shape.__geo_interface__['type'] == 'MultiLineString'):
-                    aux_list = isl_features[i].shape.__geo_interface__['coordinates']
-                    aux_coords = np.vstack([aux_list[j] for j in range(len(aux_list))])
-                    mean_lon, mean_lat = np.mean(aux_coords, axis = 0)
-                else:
-                    print('Unknown type: ' + isl_features[i].shape.__geo_interface__['type'])
-                    continue
-            
-                self.isl[cnt, :] = [mean_lon, mean_lat, isl_attr[i]]
-                cnt += 1
-               
-        # Calculating first simulation step and retrieving particles lon/lat
-        self._gnome.step(datetime.now() + timedelta(hours=3)) # -03 GMT timezone
-        self.lon, self.lat = self._gnome.get_particles()
+        # Read ISL shape file (preprocessed centroids are cached)
+        self.isl = load_isl(ISL_SHP) # [lon, lat, isl_value]
+        self.uid = uuid.uuid4().hex[:12]     # Identifies the static layers (ISL) of this simulation
 
-   
-    def _run(self):        
-        # Cyclic code here
-        self._gnome.save_particles(self.lon, self.lat)
+        # Spatial index over ISL centroids for potential field computation
+        self.isl_field = IslPotentialField(self.isl)
+               
+        # Map frames are only rendered on request, the renderer is created by the first one
+        self._renderer = None
+        self._renderer_lock = Lock()
 
-        #self._gnome.step(datetime(2020, 9, 15, 12, 0, 0))
-        self._gnome.step(datetime.now() + timedelta(hours=3)) # -03 GMT timezone
+        # Particles of past steps
+        self.history = ParticleHistory()
 
-        self.lon, self.lat = self._gnome.get_particles()
+        # Run-ahead forecasts, worker processes are started on first request
+        self._forecaster = None
 
-        if self.mission != None :
+        # Perturbed ensemble members, stepped in worker processes along with the live model (control member)
+        self._ensemble = Ensemble(north, south, east, west)
 
-            I1 = np.where(self.lon >= self.mission.minLon)[0]
-            lonI = self.lon[I1]
-            latI = self.lat[I1]
+        # Particles, mission KDE and cells are changed only with the writer lock held (steps and robot
+        # consumption, in order) and then published as a new immutable snapshot. Readers never lock
+        self._writer = Lock()
+        self.version = 0
+        self.snapshot = None
+        self._deltas = None     # Cells consumed while a step is being computed, replayed on its particles
 
-            I2 = np.where(lonI <= self.mission.maxLon)[0]
-            lonI = lonI[I2]
-            latI = latI[I2]
+        # Published snapshots and robot moves are announced to clients (server-sent events)
+        self.events = EventBus()
 
-            I3 = np.where(latI >= self.mission.minLat)[0]
-            lonI = lonI[I3]
-            latI = latI[I3]
+        # Particles responses and map tiles, built once per snapshot
+        self._encoder = ParticlesEncoder()
+        self._tiles = TileCache()
 
-            I4 = np.where(latI <= self.mission.maxLat)[0]
-            lonI = lonI[I4]
-            latI = latI[I4]
+        # Calculating first simulation step and retrieving particles lon/lat
+        self.step_time = datetime.now() + timedelta(hours=3) # -03 GMT timezone
+        self._gnome.step(self.step_time)
+        self.particles = self._new_particles(self.step_time)
+        with self._writer:
+            self._publish('step')
 
-            self.mission.idx = I1[I2[I3[I4]]]
+   
+    def _run(self):        
+        # Cyclic code here
+        with self._writer:
+            lon, lat, member = self.particles.lon, self.particles.lat, self.particles.member
+            self._gnome.save_particles(lon[member == 0], lat[member == 0])
+            self._deltas = []
 
-            self.mission.kde = self.mission._compute_kde(lonI, latI)
-            
-        # Unlocks timer
-        self.is_running = False
-        self.start()
+        #self._gnome.step(datetime(2020, 9, 15, 12, 0, 0))
+        step_time = datetime.now() + timedelta(hours=3) # -03 GMT timezone
+        pending = self._ensemble.submit(step_time, lon, lat, member)
+        self._gnome.step(step_time)
+
+        particles = self._new_particles(step_time, self._ensemble.gather(pending))
+        # Spatial index of the step, shared by the snapshots published until next step
+        particles.spatial_index()
+
+        # KDE is computed before taking the lock, robot feedback is not held during it
+        mission = self.mission
+        if mission != None :
+            prepared = mission._prepare_kde(particles)
+
+        with self._writer:
+            self.step_time = step_time
+            self.particles = particles
+            if self.mission != None :
+                if mission is self.mission:
+                    mission._apply_kde(particles, prepared)
+                else:
+                    # Mission was set during the step
+                    self.mission._update_kde()
+
+            # Replaying robot consumption received during the step
+            deltas = self._deltas
+            self._deltas = None
+            self._consume(deltas)
+            self._publish('step')
+
+        if self._forecaster is not None:
+            self._forecaster.update(self.step_time, *self.snapshot.member_particles())
+
+    def _new_particles(self, step_time, members=None):
+        # New particles from gnome step (control member) and perturbed members (in water only).
+        # History keeps the control member particles (with status)
+        lon, lat, status = self._gnome.get_particles()
+        in_water = status == 2
+
+        if members is None:
+            # Perturbed members start from the control particles
+            n = self._ensemble.n_members - 1
+            members = (np.tile(lon[in_water], n), np.tile(lat[in_water], n), np.repeat(np.arange(1, n + 1), np.sum(in_water)))
+        lon_m, lat_m, member_m = members
+
+        self.history.append(calendar.timegm(step_time.timetuple()), lon, lat, status)
+
+        # Members particles are equally weighted, so the KDE of their union is the ensemble probability
+        return ParticleStore(np.concatenate([lon[in_water], lon_m]), np.concatenate([lat[in_water], lat_m]), \
+            np.concatenate([np.zeros(np.sum(in_water), dtype='uint16'), member_m]))
+
+    def _consume(self, cells):
+        # Called with the writer lock held
+        consumed = []
+        for xgrid, ygrid in cells:
+            lon_c, lat_c = self.particles.consume_cell(xgrid, ygrid)
+            consumed.append((xgrid, ygrid, lon_c, lat_c))
+        if self.mission != None :
+            self.mission._apply_consumption(consumed)
+        return consumed
+
+    def _publish(self, kind):
+        # Called with the writer lock held. kind: 'step' (new particles), 'kde' (robot consumption) or 'mission' (new mission)
+        self.version += 1
+        idx, binX, binY = self.particles.bound_cells()
+        kde = self.mission.kde if self.mission != None else None
+        self.snapshot = Snapshot(self.version, self.step_time, self.particles.lon, self.particles.lat, self.particles.member, \
+            self.mission, kde, idx, binX, binY, self.particles.spatial_index(), self.particles.alive_mask())
+        self.events.publish(kind, {'version': self.version, 'step_time': self.step_time.isoformat()})
+
+    def consume_cells(self, cells):
+        # Robot consumption of grid cells (xgrid, ygrid), applied on top of the latest snapshot
+        with self._writer:
+            if self._deltas is not None:
+                self._deltas.extend(cells)
+            consumed = self._consume(cells)
+            if any(len(c[2]) > 0 for c in consumed):
+                self._publish('kde')
 
     def report_oil(self, lon, lat):
         self._gnome.add_oil(lon, lat)
+        self._ensemble.add_oil(lon, lat)
     
-    def get_particles(self, minLon, maxLon, minLat, maxLat):
-        # Compute new global idx
-        I1 = np.where(self.lon >= minLon)[0]
-        lonI = self.lon[I1]
-        latI = self.lat[I1]
-
-        I2 = np.where(lonI <= maxLon)[0]
-        lonI = lonI[I2]
-        latI = latI[I2]
-
-        I3 = np.where(latI >= minLat)[0]
-        lonI = lonI[I3]
-        latI = latI[I3]
-
-        I4 = np.where(latI <= maxLat)[0]
-        lonI = lonI[I4]
-        latI = latI[I4]
-
-        #return np.vstack([lonI, latI])
-        return np.vstack([self.lon, self.lat])
+    def get_particles_encoded(self, minLon, maxLon, minLat, maxLat, format_name, compress):
+        # Encoded particles inside the bounding box (see transport) and the snapshot version they belong to
+        minLon, maxLon = min(minLon, maxLon), max(minLon, maxLon)
+        minLat, maxLat = min(minLat, maxLat), max(minLat, maxLat)
+
+        snapshot = self.snapshot
+        return self._encoder.get(snapshot, (minLon, maxLon, minLat, maxLat), format_name, compress), snapshot.version
+
+    def get_tile(self, layer, z, x, y, compress):
+        # Aggregated tile z/x/y of a layer (see tiles) and the snapshot version it belongs to, None if there is no such tile
+        if layer not in LAYERS or z < 0 or z > MAX_ZOOM or x < 0 or y < 0 or x >= 2 ** z or y >= 2 ** z:
+            return None, None
+        snapshot = self.snapshot
+        return self._tiles.get(snapshot, layer, z, x, y, compress), snapshot.version
+
+    def get_particles_history(self, t):
+        # Particles of the latest step at or before t (unix seconds)
+        step_t, records = self.history.get(t)
+        if step_t is None:
+            return None, None, None
+        return datetime.utcfromtimestamp(step_t), np.vstack([records['lon'], records['lat']]), records['status']
+
+    def get_history_steps(self):
+        return [datetime.utcfromtimestamp(t) for t in self.history.steps()]
+
+    def request_frame(self):
+        # Queue a map frame of the current particles, rendered in background
+        with self._renderer_lock:
+            if self._renderer is None:
+                base_dir = os.path.dirname(__file__)
+                self._renderer = FrameRenderer(self._gnome.mapfile, os.path.join(base_dir, 'images'), \
+                    ((self.west, self.south), (self.east, self.north)))
+        snapshot = self.snapshot
+        return self._renderer.request(*snapshot.member_particles(), snapshot.step_time)
+
+    def get_frame(self):
+        # Latest rendered frame file and its step time, None if no frame was rendered yet
+        if self._renderer is None or self._renderer.frame_time is None:
+            return None, None
+        return self._renderer.frame_file, self._renderer.frame_time
+
+    def get_forecast(self):
+        # Finished forecasts: horizon -> (run version, valid time, lon, lat), and horizons still being computed
+        if self._forecaster is None:
+            self._forecaster = Forecaster(self.north, self.south, self.east, self.west)
+            snapshot = self.snapshot
+            self._forecaster.update(snapshot.step_time, *snapshot.member_particles())
+        return self._forecaster.get(), self._forecaster.pending()
 
     def get_isl(self):
         return self.isl
     
     def set_mission(self, mission):
-        self.mission = mission
+        with self._writer:
+            self.mission = mission
+            mission._update_kde()
+            self._publish('mission')
+
+    @property
+    def is_running(self):
+        return self._scheduler.is_running
+
+    def get_scheduler_stats(self):
+        return self._scheduler.stats()
 
     def start(self):
-        if not self.is_running:
-            self._timer = Timer(self.interval, self._run)
-            self._timer.start()
-            self.is_running = True
+        self._scheduler.start()
 
     def stop(self):
-        self._timer.cancel()
-        self.is_running = False
+        self._scheduler.stop()
+        with self._renderer_lock:
+            if self._renderer is not None:
+                self._renderer.stop()
+        if self._forecaster is not None:
+            self._forecaster.stop()
+        self._ensemble.stop()
 
@@ -0,0 +1,52 @@
+import numpy as np
+
+from particle_store import ParticleIndex
+
+def _frozen(array):
+    # Read only view, the owner keeps its writable array
+    if array is None:
+        return None
+    view = np.asarray(array).view()
+    view.flags.writeable = False
+    return view
+
+class Snapshot(object):
+    # Immutable state published after each step and each robot consumption.
+    # Readers take simulation.snapshot once and use only its fields, so they never see two different versions
+    def __init__(self, version, step_time, lon, lat, member, mission=None, kde=None, idx=None, binX=None, binY=None, \
+        index=None, alive=None):
+        self.version = version
+        self.step_time = step_time
+
+        # Alive particles
+        self.lon = _frozen(lon)
+        self.lat = _frozen(lat)
+        self.member = _frozen(member)
+
+        # Mission KDE, particles inside the mission bounding box (indexes in lon/lat) and their grid cells
+        self.mission = mission
+        self.kde = _frozen(kde)
+        self.idx = _frozen(idx)
+        self.binX = _frozen(binX)
+        self.binY = _frozen(binY)
+
+        # Spatial index of the step particles (shared by all snapshots of the step) and their alive flags when published.
+        # Without them an index over the alive particles is built on first query
+        self._index = index
+        self._alive = _frozen(alive)
+
+    def bbox(self, minLon, maxLon, minLat, maxLat, member=0):
+        # lon/lat of alive particles of an ensemble member (control run by default, None for all) inside the bounding box
+        if self._index is None:
+            self._index = ParticleIndex(self.lon, self.lat, self.member)
+        idx = self._index.query(minLon, maxLon, minLat, maxLat)
+        if self._alive is not None:
+            idx = idx[self._alive[idx]]
+        if member is not None and self._index.member is not None:
+            idx = idx[self._index.member[idx] == member]
+        return self._index.lon[idx], self._index.lat[idx]
+
+    def member_particles(self, member=0):
+        # lon/lat of alive particles of an ensemble member (control run by default)
+        in_member = self.member == member
+        return self.lon[in_member], self.lat[in_member]
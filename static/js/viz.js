@@ -5,7 +5,13 @@ let region, polygon, region_drawn;
 let isl_markers, isl_drawn;
 let configured_mission;
 
-var interval = setInterval(run, 3000); // 3 seconds repeat
+// Server pushes a message when particles, KDE or robots change, instead of polling every 3 seconds.
+// Unchanged artifacts are revalidated by the browser cache (ETag)
+var events = new EventSource('http://127.0.0.1:5000/events');
+events.addEventListener('step', loadTiles);
+events.addEventListener('kde', loadTiles);
+events.addEventListener('mission', loadTiles);
+events.addEventListener('robots', loadRobots);
 
 function initMap() {
 
@@ -15,19 +21,13 @@ function initMap() {
         mapTypeId: "roadmap",
     });
 
-    // Particles
-    $.getJSON({
-        url: 'http://127.0.0.1:5000/simulation/particles/minLon:-36&maxLon:-33&minLat:-4&maxLat:-11',
-        success: function(data) {
-
-            heatmap = new google.maps.visualization.HeatmapLayer({
-                data: getPoints(data.particles),
-                map: map,
-                radius: 20
-            });
-
-        }
+    // Particles, aggregated in tiles of the visible area
+    heatmap = new google.maps.visualization.HeatmapLayer({
+        data: [],
+        map: map,
+        radius: 20
     });
+    map.addListener('idle', loadTiles);
 
     // ISL
     $.getJSON({
@@ -169,30 +169,50 @@ function toggleISL() {
     }
 }
 
-function getPoints(particles) {
-    var latlng = [];
-
-    for (var i = 0; i < particles[0].length; i++) {
-        latlng.push(new google.maps.LatLng(particles[1][i], particles[0][i]));
-    }
-
-    return latlng;
+function lon2tile(lon, zoom) {
+    return Math.floor((lon + 180) / 360 * Math.pow(2, zoom));
 }
 
-function run() {
-    // KDE
-    $.getJSON({
-        url: 'http://127.0.0.1:5000/simulation/particles/minLon:-36&maxLon:-33&minLat:-4&maxLat:-11',
-        success: function(data) {
-
-            particles_points = getPoints(data.particles);
+function lat2tile(lat, zoom) {
+    var rad = lat * Math.PI / 180;
+    return Math.floor((1 - Math.log(Math.tan(rad) + 1 / Math.cos(rad)) / Math.PI) / 2 * Math.pow(2, zoom));
+}
 
-            heatmap.setData(particles_points);
+function loadTiles() {
+    // Particles counts of the tiles in view, payload depends on the viewport and not on the particles count
+    var bounds = map ? map.getBounds() : null;
+    if (!bounds) {
+        return;
+    }
+    var zoom = Math.min(map.getZoom(), 18);
+    var n = Math.pow(2, zoom);
+    var x0 = lon2tile(bounds.getSouthWest().lng(), zoom);
+    var x1 = lon2tile(bounds.getNorthEast().lng(), zoom);
+    var y0 = Math.max(lat2tile(bounds.getNorthEast().lat(), zoom), 0);
+    var y1 = Math.min(lat2tile(bounds.getSouthWest().lat(), zoom), n - 1);
+
+    var requests = [];
+    for (var x = x0; x <= x1; x++) {
+        for (var y = y0; y <= y1; y++) {
+            var url = 'http://127.0.0.1:5000/simulation/tiles/particles/' + zoom + '/' + ((x % n) + n) % n + '/' + y;
+            requests.push(fetch(url).then(function(response) { return response.json(); }));
+        }
+    }
 
+    Promise.all(requests).then(function(tiles) {
+        var points = [];
+        for (var i = 0; i < tiles.length; i++) {
+            var tile_points = tiles[i].points || [];
+            for (var j = 0; j < tile_points.length; j++) {
+                points.push({ location: new google.maps.LatLng(tile_points[j][1], tile_points[j][0]), weight: tile_points[j][2] });
+            }
         }
+        heatmap.setData(points);
     });
+}
 
-    if (configured_mission) {
+function loadRobots() {
+    if (configured_mission && robots_markers) {
         // Robots
         $.getJSON({
             url: 'http://127.0.0.1:5000/mission/robots_lon_lat',
@@ -0,0 +1,65 @@
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from downloads import DownloadManager
+
+BODY = bytes(range(256)) * 1024
+
+def serve(partial_responses):
+    # Stand-in weather server: the first partial_responses requests close the connection halfway through the body
+    requests_served = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            requests_served.append(self.path)
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(BODY)))
+            self.end_headers()
+            if len(requests_served) <= partial_responses:
+                self.wfile.write(BODY[:len(BODY)//2])
+            else:
+                self.wfile.write(BODY)
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:%d/data.nc' % server.server_port, requests_served
+
+def test_retry_after_failed_chunk(tmp_path):
+    server, url, served = serve(partial_responses=1)
+    downloads = DownloadManager(retries=2, backoff=0.01)
+    filename = str(tmp_path / 'data.nc')
+    try:
+        downloads.fetch(url, filename)
+    finally:
+        downloads.close()
+        server.shutdown()
+
+    assert len(served) == 2
+    with open(filename, 'rb') as dataFile:
+        assert dataFile.read() == BODY
+    assert os.listdir(str(tmp_path)) == ['data.nc']
+
+def test_failed_download_keeps_previous_file(tmp_path):
+    server, url, served = serve(partial_responses=3)
+    downloads = DownloadManager(retries=2, backoff=0.01)
+    filename = str(tmp_path / 'data.nc')
+    with open(filename, 'wb') as dataFile:
+        dataFile.write(b'previous')
+    try:
+        with pytest.raises(requests.exceptions.ChunkedEncodingError):
+            downloads.fetch(url, filename)
+    finally:
+        downloads.close()
+        server.shutdown()
+
+    assert len(served) == 3
+    with open(filename, 'rb') as dataFile:
+        assert dataFile.read() == b'previous'
+    assert os.listdir(str(tmp_path)) == ['data.nc']
@@ -0,0 +1,68 @@
+import numpy as np
+from scipy.stats import gaussian_kde
+from shapely import geometry
+
+from grid_maps import rasterize_region, BinnedKDE
+from mission import KDE_BW, RES_GRID
+
+MIN_LON, MIN_LAT, WIDTH, HEIGHT = -35.9, -10.2, 155, 133    # Synthetic grid, about 1.4 x 1.2 degrees
+MAX_ABS_ERROR = 0.1         # Binned against exact KDE on the [0, 5] grid scale (measured 0.019)
+MAX_RELATIVE_ERROR = 0.05   # Binned against exact density, cells above 5% of the peak (measured 0.018)
+
+def synthetic_particles(n=5000, seed=0):
+    # Correlated blob, like a spill drifting along the coast
+    rng = np.random.default_rng(seed)
+    lon = rng.normal(-35.2, 0.15, n)
+    lat = 0.6 * (lon + 35.2) + rng.normal(-9.6, 0.1, n)
+    return lon, lat
+
+def cell_centers():
+    x = MIN_LON + (np.arange(WIDTH) + 0.5)/RES_GRID
+    y = MIN_LAT + (np.arange(HEIGHT) + 0.5)/RES_GRID
+    return x, y
+
+def exact_density(x, y, lon, lat):
+    xx, yy = np.meshgrid(x, y)
+    f = gaussian_kde(np.vstack([lon, lat]), bw_method=KDE_BW)
+    return f.evaluate(np.vstack([xx.ravel(), yy.ravel()])).reshape(xx.shape)
+
+def test_binned_density_relative_error():
+    lon, lat = synthetic_particles()
+    x, y = cell_centers()
+
+    exact = exact_density(x, y, lon, lat)
+    binned = BinnedKDE(x, y, lon, lat, KDE_BW).evaluate()
+
+    assert binned.shape == exact.shape
+    significant = exact > 0.05 * np.max(exact)
+    relative = np.abs(binned - exact)[significant]/exact[significant]
+    assert np.max(relative) < MAX_RELATIVE_ERROR
+
+def test_binned_kde_grid_error():
+    # Mission grid scale: density scaled to [0, 5] inside the region, no fly zones at -1
+    region = geometry.box(MIN_LON, MIN_LAT, MIN_LON + WIDTH/RES_GRID, MIN_LAT + HEIGHT/RES_GRID)
+    no_fly = geometry.Point(-35.2, -9.6).buffer(0.1)
+    mask, mask_idx = rasterize_region(region, [no_fly], MIN_LON, MIN_LAT, WIDTH, HEIGHT, RES_GRID)
+    assert np.any(mask == 1) and np.any(mask == 0)
+
+    lon, lat = synthetic_particles()
+    x, y = cell_centers()
+    exact = exact_density(x, y, lon, lat)
+    binned = BinnedKDE(x, y, lon, lat, KDE_BW).evaluate()
+
+    grid = lambda f: 5/np.max(f) * (1 - mask) * f - mask
+    assert np.max(np.abs(grid(binned) - grid(exact))) < MAX_ABS_ERROR
+
+def test_binned_kde_remove():
+    # Removing particles gives the density of the remaining ones (same bandwidth)
+    lon, lat = synthetic_particles()
+    x, y = cell_centers()
+    density = BinnedKDE(x, y, lon, lat, KDE_BW)
+    removed = lon < -35.3
+    density.remove(lon[removed], lat[removed])
+
+    kept = BinnedKDE(x, y, lon, lat, KDE_BW)
+    kept.density[:] = 0
+    kept.add(lon[~removed], lat[~removed])
+    kept.n = np.sum(~removed)
+    assert np.allclose(density.evaluate(), kept.evaluate(), atol=1e-9 * np.max(kept.evaluate()))
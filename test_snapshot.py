@@ -0,0 +1,53 @@
+import gzip
+import json
+
+import numpy as np
+
+from particle_store import ParticleStore
+from snapshot import Snapshot
+from tiles import TileCache
+from transport import ParticlesEncoder, decode_delta
+
+BBOX = (-36.5, -34.0, -11.0, -8.5)
+
+def published(particles, version=1):
+    return Snapshot(version, None, particles.lon, particles.lat, particles.member, \
+        index=particles.spatial_index(), alive=particles.alive_mask())
+
+def test_empty_snapshot():
+    snapshot = published(ParticleStore([], []))
+    lon, lat = snapshot.bbox(*BBOX)
+    assert len(lon) == 0 and len(lat) == 0
+
+    lon, lat = decode_delta(ParticlesEncoder().get(snapshot, BBOX, 'delta', False))
+    assert len(lon) == 0
+    tile = json.loads(gzip.decompress(TileCache().get(snapshot, 'particles', 6, 22, 33, True)))
+    assert tile['points'] == []
+
+def test_all_particles_consumed():
+    particles = ParticleStore([-35.0, -35.01], [-9.5, -9.51])
+    particles.bind_cells(np.arange(2), np.zeros(2, dtype='int'), np.zeros(2, dtype='int'), 1, 1)
+    particles.consume_cell(0, 0)
+    assert len(particles) == 0
+
+    lon, lat = published(particles).bbox(*BBOX)
+    assert len(lon) == 0
+
+def test_snapshot_keeps_published_particles():
+    particles = ParticleStore([-35.0, -34.5], [-9.5, -9.0])
+    particles.bind_cells(np.arange(2), np.array([0, 1]), np.array([0, 0]), 2, 1)
+    before = published(particles, 1)
+    particles.consume_cell(0, 0)
+    after = published(particles, 2)
+
+    assert list(before.bbox(*BBOX)[0]) == [-35.0, -34.5]
+    assert list(after.bbox(*BBOX)[0]) == [-34.5]
+
+def test_snapshot_shows_control_member():
+    particles = ParticleStore([-35.0, -34.9, -34.8], [-9.5, -9.4, -9.3], [0, 1, 2])
+    snapshot = published(particles)
+
+    assert list(snapshot.bbox(*BBOX)[0]) == [-35.0]
+    assert list(snapshot.bbox(*BBOX, member=2)[0]) == [-34.8]
+    assert len(snapshot.bbox(*BBOX, member=None)[0]) == 3
+    assert list(snapshot.member_particles()[1]) == [-9.5]
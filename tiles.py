@@ -0,0 +1,77 @@
+import json
+
+import numpy as np
+
+from transport import VersionedCache, encode
+
+TILE_BINS = 32              # Aggregation cells per tile side
+MAX_ZOOM = 18
+TILE_CACHE_ENTRIES = 512    # Tiles kept for the latest snapshot
+
+def tile_bounds(z, x, y):
+    # (minLon, maxLon, minLat, maxLat) of web mercator tile z/x/y
+    n = 2 ** z
+    minLon = x/n * 360 - 180
+    maxLon = (x + 1)/n * 360 - 180
+    maxLat = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * y/n))))
+    minLat = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * (y + 1)/n))))
+    return minLon, maxLon, minLat, maxLat
+
+def _tile_cells(lon, lat, z, x, y, bins):
+    # Aggregation cell (flat index) of points inside tile z/x/y
+    n = 2 ** z
+    fx = (lon + 180)/360 * n - x
+    fy = (1 - np.log(np.tan(np.radians(lat)) + 1/np.cos(np.radians(lat)))/np.pi)/2 * n - y
+    cx = np.clip((fx * bins).astype('int'), 0, bins - 1)
+    cy = np.clip((fy * bins).astype('int'), 0, bins - 1)
+    return cy * bins + cx
+
+def _cell_centers(z, x, y, bins):
+    n = 2 ** z * bins
+    cx = np.arange(bins) + x * bins + 0.5
+    cy = np.arange(bins) + y * bins + 0.5
+    lon = cx/n * 360 - 180
+    lat = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * cy/n))))
+    lon, lat = np.meshgrid(lon, lat)
+    return lon.ravel(), lat.ravel()
+
+def particles_tile(snapshot, z, x, y, bins=TILE_BINS):
+    # Particles count of every aggregation cell, a dense bins * bins array (flat index cy * bins + cx, empty cells are 0)
+    minLon, maxLon, minLat, maxLat = tile_bounds(z, x, y)
+    lon, lat = snapshot.bbox(minLon, maxLon, minLat, maxLat)
+    return np.bincount(_tile_cells(lon, lat, z, x, y, bins), minlength=bins * bins)
+
+def kde_tile(snapshot, z, x, y, bins=TILE_BINS):
+    # Highest mission KDE value per aggregation cell (mission grid cells inside the tile, KDE > 0 only)
+    values = np.zeros(bins * bins)
+    mission = snapshot.mission
+    if mission is None or snapshot.kde is None:
+        return values
+
+    minLon, maxLon, minLat, maxLat = tile_bounds(z, x, y)
+    cy, cx = np.nonzero(snapshot.kde > 0)
+    lon = cx/mission.res_grid + mission.minLon
+    lat = cy/mission.res_grid + mission.minLat
+    inside = (lon >= minLon) & (lon < maxLon) & (lat >= minLat) & (lat < maxLat)
+    np.maximum.at(values, _tile_cells(lon[inside], lat[inside], z, x, y, bins), snapshot.kde[cy[inside], cx[inside]])
+    return values
+
+LAYERS = {'particles': particles_tile, 'kde': kde_tile}
+
+class TileCache(object):
+    # Tiles are aggregated on first request and cached until the snapshot changes
+    def __init__(self, bins=TILE_BINS, cache_entries=TILE_CACHE_ENTRIES):
+        self.bins = bins
+        self._cache = VersionedCache(cache_entries)
+
+    def get(self, snapshot, layer, z, x, y, compress):
+        # JSON tile: {"statusCode": 200, "version": ..., "points": [[lon, lat, weight], ...]}
+        def build():
+            weights = LAYERS[layer](snapshot, z, x, y, self.bins)
+            lon, lat = _cell_centers(z, x, y, self.bins)
+            cells = np.nonzero(weights)[0]
+            points = np.column_stack([np.round(lon[cells], 6), np.round(lat[cells], 6), weights[cells]])
+            data = json.dumps({'statusCode': 200, 'version': snapshot.version, 'z': z, 'x': x, 'y': y, \
+                'points': points.tolist()}, separators=(',', ':')).encode()
+            return encode(data, compress)
+        return self._cache.get(snapshot.version, (layer, z, x, y, compress), build)
@@ -0,0 +1,169 @@
+import gzip
+import json
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+# Particles formats: name -> media type
+FORMATS = OrderedDict([
+    ('json', 'application/json'),                   # {"statusCode": 200, "particles": [[lon, ...], [lat, ...]]}
+    ('f32', 'application/octet-stream'),            # n lon then n lat, float32 little-endian
+    ('delta', 'application/x-particles-delta')      # see encode_delta
+])
+# Mission grids formats: name -> media type
+GRID_FORMATS = OrderedDict([
+    ('json', 'application/json'),                   # {"statusCode": 200, <name>: [[...], ...]}
+    ('f32', 'application/x-grid-f32'),              # see encode_grid, float32 values
+    ('u16', 'application/x-grid-u16'),              # see encode_grid, values quantized to uint16
+    ('u8', 'application/x-grid-u8')                 # see encode_grid, values quantized to uint8
+])
+GRID_DTYPES = {'f32': '<f4', 'u16': '<u2', 'u8': 'u1'}
+DELTA_SCALE = 100000    # Quantization steps per degree (about 1 m)
+GZIP_LEVEL = 6
+CACHE_ENTRIES = 16      # Encoded responses kept for the latest snapshot (bounding boxes x formats x encodings)
+
+def negotiate(accept, format_name=None, formats=FORMATS):
+    # Format from the format query parameter, otherwise from the Accept header. JSON by default
+    if format_name in formats:
+        return format_name
+    for media_range in accept.split(','):
+        media_type = media_range.split(';')[0].strip()
+        for name, format_type in formats.items():
+            if media_type == format_type:
+                return name
+    return 'json'
+
+def encode_json(lon, lat):
+    return json.dumps({'statusCode': 200, 'particles': [lon.tolist(), lat.tolist()]}, separators=(',', ':')).encode()
+
+def encode_f32(lon, lat):
+    return np.concatenate([lon, lat]).astype('<f4').tobytes()
+
+def encode_delta(lon, lat):
+    # Header: n (uint32), origin lon/lat (float64), steps per degree (float64). Then n lon and n lat deltas (int32):
+    # particles quantized to the grid and sorted by lon, each value is the difference to the previous particle one.
+    # Sorted, most deltas are small and the stream compresses well
+    n = len(lon)
+    origin_lon = float(np.min(lon)) if n > 0 else 0.0
+    origin_lat = float(np.min(lat)) if n > 0 else 0.0
+    qlon = np.round((lon - origin_lon) * DELTA_SCALE).astype('int64')
+    qlat = np.round((lat - origin_lat) * DELTA_SCALE).astype('int64')
+    order = np.lexsort((qlat, qlon))
+    dlon = np.diff(qlon[order], prepend=0).astype('<i4')
+    dlat = np.diff(qlat[order], prepend=0).astype('<i4')
+
+    header = np.array([n], dtype='<u4').tobytes() + np.array([origin_lon, origin_lat, DELTA_SCALE], dtype='<f8').tobytes()
+    return header + dlon.tobytes() + dlat.tobytes()
+
+def decode_delta(data):
+    n = int(np.frombuffer(data, dtype='<u4', count=1)[0])
+    origin_lon, origin_lat, scale = np.frombuffer(data, dtype='<f8', count=3, offset=4)
+    deltas = np.frombuffer(data, dtype='<i4', count=2 * n, offset=28)
+    lon = origin_lon + np.cumsum(deltas[:n])/scale
+    lat = origin_lat + np.cumsum(deltas[n:])/scale
+    return lon, lat
+
+ENCODERS = {'json': encode_json, 'f32': encode_f32, 'delta': encode_delta}
+
+def encode_grid(grid, format_name, low, high):
+    # Header: height, width (uint32), low, high (float64), number of masked runs (uint32). Then the runs of masked cells
+    # (cells at low, the no fly zone) as start, length pairs (uint32) over the row-major cells, then the values of the
+    # other cells in row-major order: float32, or quantized over [low, high] to the full uint16/uint8 range
+    # (error up to half a step, (high - low)/2/65535 or (high - low)/2/255)
+    height, width = grid.shape
+    cells = grid.ravel()
+    masked = np.concatenate([[False], cells <= low, [False]])
+    edges = np.flatnonzero(masked[1:] != masked[:-1])
+    starts, ends = edges[0::2], edges[1::2]
+    runs = np.column_stack([starts, ends - starts]).astype('<u4')
+
+    values = cells[cells > low]
+    dtype = GRID_DTYPES[format_name]
+    if format_name != 'f32':
+        steps = np.iinfo(dtype).max
+        values = np.round((np.clip(values, low, high) - low)/(high - low) * steps)
+    header = np.array([height, width], dtype='<u4').tobytes() + np.array([low, high], dtype='<f8').tobytes() + \
+        np.array([len(runs)], dtype='<u4').tobytes()
+    return header + runs.tobytes() + values.astype(dtype).tobytes()
+
+def decode_grid(data, format_name):
+    height, width = np.frombuffer(data, dtype='<u4', count=2)
+    low, high = np.frombuffer(data, dtype='<f8', count=2, offset=8)
+    n_runs = int(np.frombuffer(data, dtype='<u4', count=1, offset=24)[0])
+    runs = np.frombuffer(data, dtype='<u4', count=2 * n_runs, offset=28).reshape(-1, 2)
+
+    masked = np.zeros(height * width + 1, dtype='int')
+    np.add.at(masked, runs[:, 0], 1)
+    np.add.at(masked, runs[:, 0] + runs[:, 1], -1)
+    masked = np.cumsum(masked[:-1]) > 0
+
+    dtype = GRID_DTYPES[format_name]
+    values = np.frombuffer(data, dtype=dtype, offset=28 + 8 * n_runs).astype('float')
+    if format_name != 'f32':
+        values = low + values/np.iinfo(dtype).max * (high - low)
+    grid = np.full(height * width, low)
+    grid[~masked] = values
+    return grid.reshape(height, width)
+
+class VersionedCache(object):
+    # Values built from one snapshot version, dropped when a newer version shows up.
+    # Values of older versions are built but not cached
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._cache = OrderedDict()
+        self._version = None
+        self._lock = threading.Lock()
+
+    def get(self, version, key, build):
+        with self._lock:
+            if self._version is None or version > self._version:
+                self._version = version
+                self._cache.clear()
+            value = self._cache.get(key) if version == self._version else None
+            if value is not None:
+                self._cache.move_to_end(key)
+                return value
+
+        # Building without the lock, two clients may build the same entry once
+        value = build()
+
+        with self._lock:
+            if self._version == version:
+                self._cache[key] = value
+                while len(self._cache) > self.max_entries:
+                    self._cache.popitem(last=False)
+        return value
+
+def encode(data, compress):
+    if compress:
+        return gzip.compress(data, compresslevel=GZIP_LEVEL)
+    return data
+
+class ParticlesEncoder(object):
+    # Encodes each snapshot particles once per bounding box, format and content encoding, every client gets the cached bytes
+    def __init__(self, cache_entries=CACHE_ENTRIES):
+        self._cache = VersionedCache(cache_entries)
+
+    def get(self, snapshot, bbox, format_name, compress):
+        def build():
+            lon, lat = snapshot.bbox(*bbox)
+            return encode(ENCODERS[format_name](lon, lat), compress)
+        return self._cache.get(snapshot.version, (tuple(bbox), format_name, compress), build)
+
+class GridEncoder(object):
+    # Encodes a mission grid once per grid version, format and content encoding
+    def __init__(self, name, low, high, cache_entries=len(GRID_FORMATS) * 2):
+        self.name = name
+        self.low = low
+        self.high = high
+        self._cache = VersionedCache(cache_entries)
+
+    def get(self, version, grid, format_name, compress):
+        def build():
+            if format_name == 'json':
+                data = json.dumps({'statusCode': 200, self.name: grid.tolist()}, separators=(',', ':')).encode()
+            else:
+                data = encode_grid(grid, format_name, self.low, self.high)
+            return encode(data, compress)
+        return self._cache.get(version, (format_name, compress), build)
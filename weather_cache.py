@@ -0,0 +1,184 @@
+import json
+import os
+import uuid
+from datetime import timedelta
+
+import netCDF4 as nc
+
+from atomic_file import atomic_write, tmp_path, versioned_path, remove_old_versions
+from weather_preprocess import time_dimension, validate, repack
+
+CACHE_DIR = './assets/cache/weather'
+WEATHER_RETENTION = timedelta(days=1)   # Cached steps kept before the requested window start
+
+def _contains(outer, inner):
+    # bbox as (north, south, east, west)
+    return outer[0] >= inner[0] and outer[1] <= inner[1] and outer[2] >= inner[2] and outer[3] <= inner[3]
+
+def _times(dataset, tdim):
+    tvar = dataset.variables[tdim]
+    return nc.num2date(tvar[:], tvar.units, getattr(tvar, 'calendar', 'standard'), \
+        only_use_cftime_datetimes=False, only_use_python_datetimes=True)
+
+def read_times(filename):
+    if not os.path.exists(filename):
+        return []
+    with nc.Dataset(filename) as dataset:
+        return list(_times(dataset, time_dimension(dataset)))
+
+def merge(filenames, output, start=None, end=None):
+    # Concatenates files of the same grid along time into output (published atomically), keeping steps
+    # in [start, end]. A step present in more than one file is taken from the last one
+    datasets = [nc.Dataset(f) for f in filenames]
+    try:
+        first = datasets[0]
+        tdim = time_dimension(first)
+        tvar = first.variables[tdim]
+        calendar = getattr(tvar, 'calendar', 'standard')
+
+        steps = {}      # step time -> (dataset, index)
+        for i, dataset in enumerate(datasets):
+            for j, t in enumerate(_times(dataset, time_dimension(dataset))):
+                steps[t] = (i, j)
+        kept = sorted(t for t in steps if (start is None or t >= start) and (end is None or t <= end))
+
+        with atomic_write(output) as tmp:
+            with nc.Dataset(tmp, 'w', format='NETCDF4') as out:
+                out.setncatts({a: first.getncattr(a) for a in first.ncattrs()})
+                for name, dim in first.dimensions.items():
+                    out.createDimension(name, None if name == tdim or dim.isunlimited() else len(dim))
+
+                for name, var in first.variables.items():
+                    v = out.createVariable(name, var.dtype, var.dimensions, fill_value=getattr(var, '_FillValue', None))
+                    v.setncatts({a: var.getncattr(a) for a in var.ncattrs() if a != '_FillValue'})
+                    if name == tdim:
+                        v[:] = nc.date2num(kept, tvar.units, calendar)
+                    elif tdim in var.dimensions:
+                        axis = var.dimensions.index(tdim)
+                        for k, t in enumerate(kept):
+                            i, j = steps[t]
+                            index = (slice(None),) * axis + (k,)
+                            v[index] = datasets[i].variables[name][(slice(None),) * axis + (j,)]
+                    elif var.dimensions == ():
+                        v.assignValue(var.getValue())
+                    else:
+                        v[:] = var[:]
+    finally:
+        for dataset in datasets:
+            dataset.close()
+
+class WeatherCache(object):
+    # Downloaded weather steps kept per dataset and bbox, so only missing time ranges are requested
+    def __init__(self, downloads, cache_dir=CACHE_DIR, retention=WEATHER_RETENTION):
+        self.downloads = downloads
+        self.cache_dir = cache_dir
+        self.retention = retention
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self._index_file = os.path.join(cache_dir, 'index.json')
+        try:
+            with open(self._index_file) as indexFile:
+                self._entries = json.load(indexFile)
+        except (OSError, ValueError):
+            self._entries = []
+        self._entries = [e for e in self._entries if os.path.exists(os.path.join(cache_dir, e['file']))]
+
+    def _save_index(self):
+        with atomic_write(self._index_file) as tmp:
+            with open(tmp, 'w') as indexFile:
+                json.dump(self._entries, indexFile)
+
+    def _find(self, dataset, bbox):
+        # Entry for the bbox itself, otherwise the smallest cached bbox containing it
+        candidates = [e for e in self._entries if e['dataset'] == dataset and _contains(e['bbox'], bbox)]
+        if len(candidates) == 0:
+            return None
+        return min(candidates, key=lambda e: (e['bbox'][0] - e['bbox'][1]) * (e['bbox'][2] - e['bbox'][3]))
+
+    def _new_entry(self, dataset, bbox):
+        entry = {'dataset': dataset, 'bbox': list(bbox), 'file': dataset + '-' + uuid.uuid4().hex[:12] + '.nc'}
+        self._entries.append(entry)
+        return entry
+
+    def _drop_contained(self, entry):
+        # Cached bboxes inside entry will not be used again, dropped once entry holds data
+        for old in [e for e in self._entries if e is not entry and e['dataset'] == entry['dataset'] and _contains(entry['bbox'], e['bbox'])]:
+            self._entries.remove(old)
+            if os.path.exists(os.path.join(self.cache_dir, old['file'])):
+                os.remove(os.path.join(self.cache_dir, old['file']))
+
+    def _missing(self, dataset, bbox, start, end, request):
+        entry = self._find(dataset, bbox)
+        if entry is None:
+            entry = self._new_entry(dataset, bbox)
+        cached = os.path.join(self.cache_dir, entry['file'])
+
+        # Missing ranges before and after the cached steps (the cache is contiguous in time)
+        times = read_times(cached)
+        if len(times) == 0:
+            ranges = [(start, end)]
+        else:
+            ranges = []
+            if start < times[0]:
+                ranges.append((start, times[0]))
+            if end > times[-1]:
+                ranges.append((times[-1], end))
+
+        # Missing ranges are requested with the cached bbox, so all steps share the same grid
+        segments = [(request(tuple(entry['bbox']), s, e), tmp_path(self.cache_dir, '.nc')) for s, e in ranges]
+        return entry, len(times), segments
+
+    def update(self, jobs):
+        # jobs: [(dataset, bbox, start, end, request, output)], bbox as (north, south, east, west) and request(bbox, start, end)
+        # building the download url. Brings steps covering [start, end] of each dataset into its output file,
+        # downloading only the missing ranges (all datasets at the same time). Returns {output: error} of failed datasets
+        missing = [self._missing(dataset, bbox, start, end, request) for dataset, bbox, start, end, request, output in jobs]
+        segments = [segment for _, _, job_segments in missing for segment in job_segments]
+
+        failed = {}
+        try:
+            errors = self.downloads.fetch_all(segments)
+            for (dataset, bbox, start, end, request, output), (entry, n_cached, job_segments) in zip(jobs, missing):
+                cached = os.path.join(self.cache_dir, entry['file'])
+                downloaded = []
+                for _, f in job_segments:
+                    if f not in errors:
+                        try:
+                            validate(f)
+                            downloaded.append(f)
+                        except ValueError as error:
+                            errors[f] = error
+                    if f in errors:
+                        failed[output] = errors[f]
+                if n_cached + len(downloaded) == 0:
+                    continue
+                print('[WEATHER] ' + dataset + ': ' + str(n_cached) + ' cached steps, ' + str(len(downloaded)) + ' of ' + \
+                    str(len(job_segments)) + ' missing ranges downloaded')
+
+                window = tmp_path(self.cache_dir, '.nc')
+                try:
+                    merge(([cached] if n_cached > 0 else []) + downloaded, cached, start=start - self.retention)
+                    self._drop_contained(entry)
+
+                    # Also keeping the steps around the window, movers interpolate between steps
+                    times = read_times(cached)
+                    first = max([t for t in times if t <= start], default=start)
+                    last = min([t for t in times if t >= end], default=end)
+                    merge([cached], window, start=first, end=last)
+
+                    # Movers get the window cropped to the requested bbox, repacked for their access pattern. Published
+                    # as a new version (not replaced), movers keep the previous one open until they reload
+                    repack(window, versioned_path(output), *bbox)
+                    remove_old_versions(output)
+                except (OSError, ValueError) as error:
+                    failed[output] = error
+                finally:
+                    if os.path.exists(window):
+                        os.remove(window)
+        finally:
+            for _, f in segments:
+                if os.path.exists(f):
+                    os.remove(f)
+
+        self._save_index()
+        return failed
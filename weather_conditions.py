@@ -1,17 +1,22 @@
+from datetime import datetime, timedelta
 
-from threading import Timer
-import requests
-import os
+from scheduler import Scheduler
+from downloads import DownloadManager
+from weather_cache import WeatherCache
 
-from datetime import datetime, timedelta
+# Weather data services, can point to a local mirror or test server
+CURRENTS_URL = 'http://ncss.hycom.org/thredds/ncss/GLBy0.08/latest'
+WIND_URL = 'https://thredds.ucar.edu/thredds/ncss/grib/NCEP/GFS/Global_0p25deg/Best'
+
+CURRENTS_FILE = 'assets/currents.nc'
+WIND_FILE = 'assets/wind.nc'
 
 
 class WeatherConditions(object):
 
-    def __init__(self, interval, north=-8.5, south=-11, east=-34, west=-36.5):
-        self._timer     = None
+    def __init__(self, interval, north=-8.5, south=-11, east=-34, west=-36.5, currents_url=CURRENTS_URL, wind_url=WIND_URL):
         self.interval   = interval
-        self.is_running = False
+        self._scheduler = Scheduler('weather', interval, self._run)
         
         # Coordinates limits
         self.north = north
@@ -19,27 +24,35 @@ class WeatherConditions(object):
         self.east = east
         self.west = west
 
+        self.currents_url = currents_url
+        self.wind_url = wind_url
+        self._downloads = DownloadManager()
+        self._cache = WeatherCache(self._downloads)
+
         # considering run step interval and 2 more days
         self.time_step = timedelta(seconds = interval) + timedelta(days = 2) 
 
         # First run
         current_time = datetime.now().replace(hour=12, minute=0, second=0, microsecond=0) - timedelta(days = 1)
         end_time = current_time + self.time_step
+        self._update(current_time, end_time)
 
-        print('Getting currents weather data')
-        self.get_currents(current_time, end_time, 'assets/currents.nc')
+    def get_currents(self, start_time, end_time, filename=CURRENTS_FILE):
+        # Currents covering [start_time, end_time] in a new version of filename (see latest_version), downloading only what is not cached
+        self._update_jobs([self._currents_job(start_time, end_time, filename)])
 
-        print('Getting wind weather data')
-        self.get_wind(current_time, end_time, 'assets/wind.nc')
+    def _currents_job(self, start_time, end_time, filename=CURRENTS_FILE):
+        return ('currents', self._bbox(), start_time, end_time, lambda bbox, s, e: self._currents_request(s, e, bbox), filename)
 
-    def get_currents(self, start_time, end_time, filename):
+    def _currents_request(self, start_time, end_time, bbox=None):
         # http://ncss.hycom.org/thredds/ncss/GLBy0.08/latest?var=water_u&var=water_v&north=-8.5&west=-36.5&east=-34&south=-9.5&disableProjSubset=on&horizStride=1&time_start=2021-03-17T12%3A00%3A00Z&time_end=2021-03-20T00%3A00%3A00Z&timeStride=1&vertCoord=0.0&accept=netcdf4
         # Building url string
-        url = 'http://ncss.hycom.org/thredds/ncss/GLBy0.08/latest?var=water_u&var=water_v&'
-        url += 'north=' + str(self.north) + '&'
-        url += 'west=' + str(self.west) + '&'
-        url += 'east=' + str(self.east) + '&'
-        url += 'south=' + str(self.south) + '&'
+        url = self.currents_url + '?var=water_u&var=water_v&'
+        north, south, east, west = self._bbox() if bbox is None else bbox
+        url += 'north=' + str(north) + '&'
+        url += 'west=' + str(west) + '&'
+        url += 'east=' + str(east) + '&'
+        url += 'south=' + str(south) + '&'
         url += 'disableProjSubset=on&horizStride=1&'
         url += 'time_start=' + str(start_time.year) + '-' + str(start_time.month) + '-' + str(start_time.day)
         url += 'T' + str(start_time.hour) + '%3A' + str(start_time.minute) + '%3A' + str(start_time.second) + 'Z&'
@@ -48,24 +61,22 @@ class WeatherConditions(object):
         url += 'timeStride=1&vertCoord=0.0&accept=netcdf'
 
         print(url)
-
-        # making request
-        r = requests.get(url, allow_redirects=True)
-
-        # Save file
-        if os.path.exists(filename):
-            os.remove(filename)
-
-        with open(filename, 'wb') as currentsFile:
-            currentsFile.write(r.content)
-            currentsFile.close()
+        return url
         
-    def get_wind(self, start_time, end_time, filename):
-        url = 'https://thredds.ucar.edu/thredds/ncss/grib/NCEP/GFS/Global_0p25deg/Best?var=u-component_of_wind_height_above_ground&var=v-component_of_wind_height_above_ground&'
-        url += 'north=' + str(self.north) + '&'
-        url += 'west=' + str(self.west) + '&'
-        url += 'east=' + str(self.east) + '&'
-        url += 'south=' + str(self.south) + '&'
+    def get_wind(self, start_time, end_time, filename=WIND_FILE):
+        # Wind covering [start_time, end_time] in a new version of filename (see latest_version), downloading only what is not cached
+        self._update_jobs([self._wind_job(start_time, end_time, filename)])
+
+    def _wind_job(self, start_time, end_time, filename=WIND_FILE):
+        return ('wind', self._bbox(), start_time, end_time, lambda bbox, s, e: self._wind_request(s, e, bbox), filename)
+
+    def _wind_request(self, start_time, end_time, bbox=None):
+        url = self.wind_url + '?var=u-component_of_wind_height_above_ground&var=v-component_of_wind_height_above_ground&'
+        north, south, east, west = self._bbox() if bbox is None else bbox
+        url += 'north=' + str(north) + '&'
+        url += 'west=' + str(west) + '&'
+        url += 'east=' + str(east) + '&'
+        url += 'south=' + str(south) + '&'
         url += 'disableProjSubset=on&horizStride=1&'
         url += 'time_start=' + str(start_time.year) + '-' + str(start_time.month) + '-' + str(start_time.day)
         url += 'T' + str(start_time.hour) + '%3A' + str(start_time.minute) + '%3A' + str(start_time.second) + 'Z&'
@@ -74,37 +85,37 @@ class WeatherConditions(object):
         url += 'timeStride=1&vertCoord=10.0&accept=netcdf'
 
         print(url)
+        return url
 
-        # making request
-        r = requests.get(url, allow_redirects=True)
+    def _bbox(self):
+        return (self.north, self.south, self.east, self.west)
 
-        # Save file
-        if os.path.exists(filename):
-            os.remove(filename)
+    def _update(self, start_time, end_time):
+        # Only time ranges not already cached are downloaded (both datasets at the same time),
+        # files are only replaced by complete data
+        print('Getting currents and wind weather data')
+        self._update_jobs([self._currents_job(start_time, end_time), self._wind_job(start_time, end_time)])
 
-        with open(filename, 'wb') as windFile:
-            windFile.write(r.content)
-            windFile.close()
+    def _update_jobs(self, jobs):
+        errors = self._cache.update(jobs)
+        for filename, error in errors.items():
+            print('Could not update ' + filename + ', keeping previous data: ' + str(error))
 
     def _run(self):
         current_time = datetime.now() - timedelta(days = 1)
         end_time = current_time + self.time_step
+        self._update(current_time, end_time)
 
-        print('Getting currents weather data')
-        self.get_currents(current_time, end_time, 'assets/currents.nc')
-
-        print('Getting wind weather data')
-        self.get_wind(current_time, end_time, 'assets/wind.nc')
+    @property
+    def is_running(self):
+        return self._scheduler.is_running
 
-        self.is_running = False
-        self.start()
+    def get_scheduler_stats(self):
+        return self._scheduler.stats()
 
     def start(self):
-        if not self.is_running:
-            self._timer = Timer(self.interval, self._run)
-            self._timer.start()
-            self.is_running = True
+        self._scheduler.start()
 
     def stop(self):
-        self._timer.cancel()
-        self.is_running = False
\ No newline at end of file
+        self._scheduler.stop()
+        self._downloads.close()
@@ -0,0 +1,116 @@
+import numpy as np
+import netCDF4 as nc
+
+from atomic_file import atomic_write
+
+WEATHER_MARGIN = 0.5        # Kept around the simulation bbox (degrees), movers interpolate across the border
+COMPRESSION_LEVEL = 4
+
+def _coordinate(dataset, names, units):
+    # Coordinate variable (1-D, named as its dimension) by name or units
+    for name, var in dataset.variables.items():
+        if var.dimensions != (name,):
+            continue
+        if name.lower() in names or getattr(var, 'units', '').lower() in units:
+            return name
+    return None
+
+def coordinates(dataset):
+    # Names of the time (coordinate with 'since' units), latitude and longitude coordinates, None if missing
+    tdim = None
+    for name, var in dataset.variables.items():
+        if var.dimensions == (name,) and 'since' in getattr(var, 'units', ''):
+            tdim = name
+            break
+    lat = _coordinate(dataset, ('lat', 'latitude', 'y'), ('degrees_north', 'degree_north'))
+    lon = _coordinate(dataset, ('lon', 'longitude', 'x'), ('degrees_east', 'degree_east'))
+    return tdim, lat, lon
+
+def time_dimension(dataset):
+    tdim = coordinates(dataset)[0]
+    if tdim is None:
+        raise ValueError('No time coordinate in ' + dataset.filepath())
+    return tdim
+
+def validate(filename):
+    # Raises ValueError if the file is not usable by the GNOME grid movers
+    try:
+        dataset = nc.Dataset(filename)
+    except OSError as error:
+        raise ValueError(filename + ' is not a NetCDF file: ' + str(error))
+
+    with dataset:
+        tdim, lat, lon = coordinates(dataset)
+        if tdim is None or lat is None or lon is None:
+            raise ValueError(filename + ' has no time/latitude/longitude coordinates')
+
+        times = dataset.variables[tdim][:]
+        if len(times) == 0:
+            raise ValueError(filename + ' has no time steps')
+        if np.any(np.diff(times) <= 0):
+            raise ValueError(filename + ' time steps are not increasing')
+
+        data = [v for v in dataset.variables.values() if tdim in v.dimensions and lat in v.dimensions and lon in v.dimensions]
+        if len(data) == 0:
+            raise ValueError(filename + ' has no gridded variables')
+        for var in data:
+            if np.ma.count(var[0]) == 0:
+                raise ValueError(filename + ' ' + var.name + ' has no valid values')
+
+def _crop(values, low, high):
+    inside = np.where((values >= low) & (values <= high))[0]
+    if len(inside) == 0:
+        return None
+    # Coordinates are sorted, so the cells inside are contiguous
+    return slice(int(inside[0]), int(inside[-1]) + 1)
+
+def repack(source, output, north, south, east, west, margin=WEATHER_MARGIN, complevel=COMPRESSION_LEVEL):
+    # Validates source and writes it to output (published atomically) cropped to the bbox plus margin,
+    # gridded variables chunked by time step (movers read one whole step at a time) and compressed
+    validate(source)
+
+    with nc.Dataset(source) as src:
+        tdim, lat, lon = coordinates(src)
+
+        lons = src.variables[lon][:]
+        if np.max(lons) > 180:
+            # 0..360 longitudes (HYCOM)
+            west, east = west % 360, east % 360
+        crop = {
+            lat: _crop(src.variables[lat][:], south - margin, north + margin),
+            lon: _crop(lons, west - margin, east + margin)
+        }
+        if crop[lat] is None or crop[lon] is None:
+            raise ValueError(source + ' does not cover the simulation area')
+
+        with atomic_write(output) as tmp:
+            with nc.Dataset(tmp, 'w', format='NETCDF4') as out:
+                out.setncatts({a: src.getncattr(a) for a in src.ncattrs()})
+                for name, dim in src.dimensions.items():
+                    if name in crop:
+                        out.createDimension(name, crop[name].stop - crop[name].start)
+                    else:
+                        out.createDimension(name, None if dim.isunlimited() else len(dim))
+
+                for name, var in src.variables.items():
+                    fill_value = getattr(var, '_FillValue', None)
+                    gridded = lat in var.dimensions and lon in var.dimensions
+                    if gridded:
+                        chunks = [1 if d not in crop else crop[d].stop - crop[d].start for d in var.dimensions]
+                        v = out.createVariable(name, var.dtype, var.dimensions, fill_value=fill_value, \
+                            zlib=True, complevel=complevel, shuffle=True, chunksizes=chunks)
+                    else:
+                        v = out.createVariable(name, var.dtype, var.dimensions, fill_value=fill_value)
+                    v.setncatts({a: var.getncattr(a) for a in var.ncattrs() if a != '_FillValue'})
+
+                    # Values are copied as stored, without unpacking scale/offset
+                    var.set_auto_maskandscale(False)
+                    v.set_auto_maskandscale(False)
+                    index = tuple(crop.get(d, slice(None)) for d in var.dimensions)
+                    if var.dimensions == ():
+                        v.assignValue(var.getValue())
+                    elif gridded and tdim in var.dimensions and var.dimensions[0] == tdim:
+                        for k in range(len(src.dimensions[tdim])):
+                            v[k] = var[(k,) + index[1:]]
+                    else:
+                        v[:] = var[index]